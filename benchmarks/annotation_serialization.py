@@ -0,0 +1,83 @@
+'''
+Compare the ways the server serializes annotations read from the db, on synthetic annotation documents.
+
+    python benchmarks/annotation_serialization.py --count 1000000
+
+validated: validate the documents into AnnotationFromDB, dump them for the response model, then serialize.
+           This is what the annotation GET endpoints did before they streamed.
+streamed:  validate and serialize each document through AnnotationFromDB, as the streaming endpoints do without trusted_reads.
+trusted:   rename _id (done by $project in the db) and serialize the raw documents with orjson, as with trusted_reads.
+'''
+import argparse
+import os
+import sys
+import time
+import orjson
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+from datamodel import AnnotationFromDB, VideoAnnotationCollectionFromDB  # noqa: E402
+
+
+def make_docs(count):
+    docs = []
+    for i in range(count):
+        doc = {'_id': f'{i:024x}', 'videoId': 'video', 'frameNum': i // 4, 'label': 'nose', 'color': '#ff0000',
+               'groupIndex': None, 'isCrowd': None, 'pathes': None}
+        if i % 4 == 0:
+            doc.update({'type': 'category', 'data': None})
+        elif i % 4 == 1:
+            doc.update({'type': 'keyPoint', 'data': {'x': 10.5, 'y': 20.25}})
+        elif i % 4 == 2:
+            doc.update({'type': 'bbox', 'data': [[1.0, 2.0], [30.0, 40.0]]})
+        else:
+            doc.update({'type': 'skeleton', 'groupIndex': 'group',
+                        'data': {name: {'x': 1.5, 'y': 2.5, 'visibility': 1.0} for name in ('nose', 'head', 'tail', 'left', 'right')}})
+        docs.append(doc)
+    return docs
+
+
+def validated(docs):
+    res = VideoAnnotationCollectionFromDB(videoId='video', annotations=docs)
+    # FastAPI dumps the returned model to a dict before checking it against response_model
+    res.model_dump(by_alias=True)
+    return res.model_dump_json().encode()
+
+
+def streamed(docs, batch_size=1000):
+    chunks = []
+    for i in range(0, len(docs), batch_size):
+        chunks.append(b','.join(AnnotationFromDB.model_validate(doc).model_dump_json().encode() for doc in docs[i:i+batch_size]))
+    return b'{"videoId":"video","annotations":[' + b','.join(chunks) + b']}'
+
+
+def trusted(docs, batch_size=1000):
+    chunks = []
+    for i in range(0, len(docs), batch_size):
+        batch = []
+        for doc in docs[i:i+batch_size]:
+            doc = dict(doc)
+            doc['id'] = doc.pop('_id')
+            batch.append(doc)
+        chunks.append(orjson.dumps(batch, default=str)[1:-1])
+    return b'{"videoId":"video","annotations":[' + b','.join(chunks) + b']}'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--count', type=int, default=1000000, help='number of annotations')
+    args = parser.parse_args()
+
+    docs = make_docs(args.count)
+    print(f'{args.count} annotations')
+    results = {}
+    for fn in (validated, streamed, trusted):
+        start = time.perf_counter()
+        body = fn(docs)
+        results[fn.__name__] = time.perf_counter() - start
+        assert len(orjson.loads(body)['annotations']) == args.count
+        print(f'{fn.__name__:>10}: {results[fn.__name__]:7.2f} s, {len(body) / 2**20:7.1f} MB')
+    print(f'trusted is {results["validated"] / results["trusted"]:.1f}x faster than validated')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+from collections import OrderedDict
+from sys import getsizeof
+import numpy as np
+
+
+class ByteLRUCache:
+    '''
+    LRU cache bounded by the total size of its values in bytes.
+    sizeof(value) gives the size of a value, values larger than max_bytes are not cached.
+    '''
+    def __init__(self, max_bytes, sizeof=len):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.items = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        item = self.items.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.items.move_to_end(key)
+        return item[0]
+
+    def put(self, key, value, size=None):
+        ''' size of the value, by default sizeof(value). '''
+        if size is None:
+            size = self.sizeof(value)
+        if size > self.max_bytes:
+            return
+        self.pop(key)
+        self.items[key] = (value, size)
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, (_, lru_size) = self.items.popitem(last=False)
+            self.bytes -= lru_size
+
+    def pop(self, key):
+        item = self.items.pop(key, None)
+        if item is not None:
+            self.bytes -= item[1]
+
+    def invalidate(self, predicate):
+        ''' Remove every entry whose key matches predicate(key). '''
+        for key in [k for k in self.items if predicate(k)]:
+            self.pop(key)
+
+    def clear(self):
+        self.items.clear()
+        self.bytes = 0
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / requests if requests else 0,
+                'entries': len(self.items),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes}
+
+
+def deep_sizeof(value):
+    '''
+    Approximate memory size in bytes of a value made of lists, tuples, dicts, numbers, strings and numpy arrays.
+    Memory-mapped arrays are paged in and out by the OS and only count for their object.
+    '''
+    if isinstance(value, np.memmap):
+        return getsizeof(value)
+    nbytes = getattr(value, 'nbytes', None)
+    if nbytes is not None:
+        return nbytes
+    size = getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(deep_sizeof(k) + deep_sizeof(v) for k, v in value.items())
+    elif isinstance(value, (list, tuple)):
+        size += sum(deep_sizeof(v) for v in value)
+    return size
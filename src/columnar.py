@@ -0,0 +1,176 @@
+'''
+Columnar NPZ format of annotations, for bulk export to and import from analysis pipelines
+without going through JSON and the pydantic models one annotation at a time.
+
+Arrays of the archive, one row per annotation unless noted:
+    videos              the videos covered by the archive, one row per video. Importing replaces all their annotations.
+    id, videoId, label  strings
+    type                strings, the BtnType values
+    frameNum            int64
+    color, groupIndex   strings, '' for None
+    isCrowd             int64, -1 for None
+    layout              int32 row of layouts describing the structure of data, -1 if data is None
+    layouts             one JSON template per distinct data structure: data with every number replaced by "i" or "f"
+    offsets             int64, n+1 rows: the numbers of data of annotation k are values[offsets[k]:offsets[k+1]]
+    values              float64, the numbers of data of every annotation, in the order of their template
+    pathes_offsets      int64, n+1 rows: the JSON of pathes of annotation k is pathes[pathes_offsets[k]:pathes_offsets[k+1]]
+    pathes              uint8, utf-8 JSON of the pathes of every annotation, 'null' for None
+
+For example the key points of a video are values.reshape(-1, 2) when every annotation is a keyPoint,
+and the layouts tell which coordinate is x and which is y.
+'''
+import numpy as np
+import orjson
+from datamodel import BtnType
+
+
+STRING_COLUMNS = ('id', 'videoId', 'type', 'label', 'color', 'groupIndex')
+BTN_TYPES = [t.value for t in BtnType]
+
+
+def _flatten(data, values):
+    if isinstance(data, dict):
+        return {k: _flatten(v, values) for k, v in data.items()}
+    if isinstance(data, list):
+        return [_flatten(v, values) for v in data]
+    values.append(data)
+    return 'i' if isinstance(data, int) else 'f'
+
+
+def _expand(template, values):
+    if isinstance(template, dict):
+        return {k: _expand(v, values) for k, v in template.items()}
+    if isinstance(template, list):
+        return [_expand(v, values) for v in template]
+    value = next(values)
+    return int(value) if template == 'i' else value
+
+
+def _string(value):
+    ''' str of a value, of its value for enums like BtnType. '''
+    return str(getattr(value, 'value', value))
+
+
+def _strings(values):
+    return np.array(values, dtype=str) if len(values) > 0 else np.zeros(0, dtype='<U1')
+
+
+class AnnotationColumns:
+    '''
+    Columns of an NPZ archive, built from the annotation documents a batch at a time,
+    so that the documents of a whole project need not be held at once.
+    '''
+    def __init__(self):
+        self.columns = {name: [] for name in STRING_COLUMNS}
+        self.frame_nums = []
+        self.is_crowd = []
+        self.layout = []
+        self.layouts = {}
+        self.offsets = [0]
+        self.values = []
+        self.pathes_offsets = [0]
+        self.pathes = bytearray()
+
+    def add(self, docs):
+        '''
+        Append the annotation documents, as stored in the db with _id or as dumped by the models with id.
+        '''
+        columns = self.columns
+        for doc in docs:
+            columns['id'].append(_string(doc['_id'] if '_id' in doc else doc['id']))
+            columns['videoId'].append(_string(doc['videoId']))
+            columns['type'].append(_string(doc['type']))
+            columns['label'].append(doc['label'])
+            columns['color'].append(doc.get('color') or '')
+            columns['groupIndex'].append(_string(doc.get('groupIndex') or ''))
+            self.frame_nums.append(doc['frameNum'])
+            self.is_crowd.append(-1 if doc.get('isCrowd') is None else doc['isCrowd'])
+            data = doc.get('data')
+            if data is None:
+                self.layout.append(-1)
+            else:
+                template = orjson.dumps(_flatten(data, self.values))
+                self.layout.append(self.layouts.setdefault(template, len(self.layouts)))
+            self.offsets.append(len(self.values))
+            self.pathes += orjson.dumps(doc.get('pathes'))
+            self.pathes_offsets.append(len(self.pathes))
+
+    def save(self, videos, file, compressed=False):
+        ''' Write the annotations added so far to file as an NPZ archive covering videos. Return their number. '''
+        arrays = {name: _strings(column) for name, column in self.columns.items()}
+        arrays.update({
+            'videos': _strings([_string(v) for v in videos]),
+            'frameNum': np.array(self.frame_nums, dtype=np.int64),
+            'isCrowd': np.array(self.is_crowd, dtype=np.int64),
+            'layout': np.array(self.layout, dtype=np.int32),
+            'layouts': _strings([t.decode() for t in self.layouts]),
+            'offsets': np.array(self.offsets, dtype=np.int64),
+            'values': np.array(self.values, dtype=np.float64),
+            'pathes_offsets': np.array(self.pathes_offsets, dtype=np.int64),
+            'pathes': np.frombuffer(bytes(self.pathes), dtype=np.uint8),
+        })
+        (np.savez_compressed if compressed else np.savez)(file, **arrays)
+        return len(self.frame_nums)
+
+
+def annotations_from_npz(file):
+    '''
+    Read an archive written by AnnotationColumns.save, checking its columns rather than each annotation.
+    Return the videos it covers and the annotation documents, ready to be written to the db.
+    Raise ValueError if the archive is malformed.
+    '''
+    try:
+        with np.load(file, allow_pickle=False) as npz:
+            arrays = {name: npz[name] for name in npz.files}
+    except Exception as e:
+        raise ValueError(f'Cannot read the NPZ archive: {e}')
+    missing = [name for name in STRING_COLUMNS + ('videos', 'frameNum', 'isCrowd', 'layout', 'layouts', 'offsets', 'values', 'pathes_offsets', 'pathes')
+               if name not in arrays]
+    if len(missing) > 0:
+        raise ValueError(f'Missing arrays in the archive: {", ".join(missing)}')
+
+    n = len(arrays['id'])
+    if any(len(arrays[name]) != n for name in STRING_COLUMNS + ('frameNum', 'isCrowd', 'layout')) \
+            or len(arrays['offsets']) != n + 1 or len(arrays['pathes_offsets']) != n + 1:
+        raise ValueError('The annotation arrays of the archive have different lengths')
+    if n > 0:
+        if arrays['frameNum'].min() < 0:
+            raise ValueError('frameNum should not be negative')
+        if not np.isin(arrays['type'], BTN_TYPES).all():
+            raise ValueError(f'type should be one of {", ".join(BTN_TYPES)}')
+        if np.char.str_len(arrays['label']).max() > 100:
+            raise ValueError('label should be at most 100 characters')
+        if arrays['layout'].max() >= len(arrays['layouts']):
+            raise ValueError('layout refers to a missing template')
+        if not np.isin(arrays['videoId'], arrays['videos']).all():
+            raise ValueError('Some annotations belong to videos not listed in videos')
+    if np.any(np.diff(arrays['offsets']) < 0) or arrays['offsets'][-1] != len(arrays['values']) \
+            or np.any(np.diff(arrays['pathes_offsets']) < 0) or arrays['pathes_offsets'][-1] != len(arrays['pathes']):
+        raise ValueError('The offsets do not match the values of the archive')
+
+    templates = [orjson.loads(t) for t in arrays['layouts'].tolist()]
+    columns = {name: arrays[name].tolist() for name in STRING_COLUMNS + ('frameNum', 'isCrowd', 'layout', 'offsets', 'pathes_offsets')}
+    values = arrays['values'].tolist()
+    pathes = arrays['pathes'].tobytes()
+    docs = []
+    for k in range(n):
+        data = None
+        if columns['layout'][k] >= 0:
+            it = iter(values[columns['offsets'][k]:columns['offsets'][k+1]])
+            try:
+                data = _expand(templates[columns['layout'][k]], it)
+            except StopIteration:
+                raise ValueError(f'Annotation {columns["id"][k]} has fewer values than its layout')
+        docs.append({
+            '_id': columns['id'][k],
+            'videoId': columns['videoId'][k],
+            'frameNum': columns['frameNum'][k],
+            'type': columns['type'][k],
+            'label': columns['label'][k],
+            'color': columns['color'][k] or None,
+            'data': data,
+            'groupIndex': columns['groupIndex'][k] or None,
+            'isCrowd': None if columns['isCrowd'][k] == -1 else columns['isCrowd'][k],
+            'pathes': orjson.loads(pathes[columns['pathes_offsets'][k]:columns['pathes_offsets'][k+1]]),
+        })
+    return arrays['videos'].tolist(), docs
@@ -11,6 +11,10 @@ def getAdditionalData(name, path):
         
     return:
         [valueForFrame0, valueForFrame1, ...]. Length of the list should be equal to the number of frames in the video.
+        A numpy array with one row per frame works too, e.g. np.load(path, mmap_mode='r') for a .npy file:
+        the server only slices the frames a request asks for, so a memory-mapped file is never read as a whole.
+        Arrays of numbers can also be sent to the client as binary (format=binary), in their own dtype, e.g. float32.
+        The result is cached until the file at path is modified, so this function is not called on every request.
     '''
     #TODO
     
@@ -29,8 +29,18 @@ class VideoFromClient(BaseModel):
     path: str
     additionalFields: List[AdditionalField] = []
 
+class VideoMeta(BaseModel):
+    frame_count: float
+    fps: float
+    width: int
+    height: int
+    codec: str
+    size: int
+    mtime: float
+
 class VideoFromDB(VideoFromClient):
     videoId: ObjectId = Field(validation_alias="_id")
+    meta: Union[VideoMeta, None] = None
 
 class VideoCollectionFromDB(BaseModel):
     videos: List[VideoFromDB]
@@ -109,6 +119,11 @@ class VideoAnnotationCollectionFromDB(BaseModel):
     videoId: ObjectId
     annotations: List[AnnotationFromDB]
 
+class AnnotationPageFromDB(BaseModel):
+    videoId: ObjectId
+    annotations: List[AnnotationFromDB]
+    next: Union[str, None] = None
+
 class VideoAnnotationCollectionFromClient(VideoAnnotationCollectionFromDB):
     annotations: List[AnnotationFromClient]
 
@@ -0,0 +1,358 @@
+import asyncio
+import bisect
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import NamedTuple, Union
+import cv2 as cv
+
+
+# without a keyframe index, forward jumps up to this many frames grab instead of seeking
+MAX_GRAB = 16
+
+
+class DecoderBusy(Exception):
+    pass
+
+
+def scan_keyframes(path):
+    '''
+    Return the positions of the key frames of the video, without decoding it.
+    Packets are counted in decode order, which matches the frame number of key frames of closed GOPs.
+    For open GOPs a position can be a few frames early, which costs a few extra grabs when seeking but stays exact.
+    Return None if the backend does not report key frames.
+    '''
+    cap = cv.VideoCapture(path, cv.CAP_FFMPEG, [cv.CAP_PROP_FORMAT, -1])
+    try:
+        if not cap.isOpened():
+            return None
+        keyframes = []
+        num = 0
+        while cap.grab():
+            if cap.get(cv.CAP_PROP_LRF_HAS_KEY_FRAME):
+                keyframes.append(num)
+            num += 1
+        return keyframes if len(keyframes) > 0 and keyframes[0] == 0 else None
+    finally:
+        cap.release()
+
+
+# format: (file extension, quality flag, media type)
+FORMATS = {
+    'jpg': ('.jpg', cv.IMWRITE_JPEG_QUALITY, 'image/jpeg'),
+    'webp': ('.webp', cv.IMWRITE_WEBP_QUALITY, 'image/webp'),
+    'png': ('.png', None, 'image/png'),
+}
+
+
+class EncodeParams(NamedTuple):
+    '''
+    How a frame is sent to the client. Hashable, so that it can be part of cache keys.
+    quality is 1-100 and ignored for png, None means the OpenCV default.
+    '''
+    format: str = 'jpg'
+    width: Union[int, None] = None
+    height: Union[int, None] = None
+    quality: Union[int, None] = None
+
+    @property
+    def media_type(self):
+        return FORMATS[self.format][2]
+
+    def validate(self):
+        if self.format not in FORMATS:
+            raise ValueError(f'Unsupported format {self.format}, use one of {", ".join(FORMATS)}')
+        if (self.width is not None and self.width < 1) or (self.height is not None and self.height < 1):
+            raise ValueError('Frame width and height should be positive')
+        if self.quality is not None and not 1 <= self.quality <= 100:
+            raise ValueError('Quality should be between 1 and 100')
+
+
+def resize(frame, width=None, height=None):
+    '''
+    Downscale the frame to width and/or height, keeping the aspect ratio if only one is given.
+    '''
+    if width is None and height is None:
+        return frame
+    h, w = frame.shape[:2]
+    if width is None:
+        width = round(w * height / h)
+    elif height is None:
+        height = round(h * width / w)
+    if width >= w and height >= h:
+        return frame
+    return cv.resize(frame, (width, height), interpolation=cv.INTER_AREA)
+
+
+def encode(frame, params):
+    ext, quality_flag, _ = FORMATS[params.format]
+    flags = [quality_flag, params.quality] if quality_flag is not None and params.quality is not None else []
+    ret, frame_1d = cv.imencode(ext, resize(frame, params.width, params.height), flags)
+    return frame_1d.tobytes()
+
+
+class VideoDecoder:
+    '''
+    One cv.VideoCapture plus the number of the frame its next read() returns,
+    so that sequential reads can skip the seek.
+    The capture is opened lazily by the first job, all cv calls are expected to run on the pool executor.
+    During sequential playback, readahead holds the frames decoded ahead of the client.
+    With a keyframe index, seeks go to the preceding key frame and grab forward, so that they are frame accurate.
+    '''
+    def __init__(self, path, videoId=None, keyframes=None):
+        self.path = path
+        self.videoId = videoId
+        self.keyframes = keyframes
+        self.cap = None
+        self.next_frame_num = 0
+        self.last_used = time.monotonic()
+        # lock serializes the jobs of this decoder on the event loop, cap_lock guards the capture between threads
+        self.lock = asyncio.Lock()
+        self.cap_lock = threading.Lock()
+        self.last_requested = None
+        self.streak = 0
+        self.readahead = {}
+        self.readahead_params = None
+        self.prefetch_task = None
+        # bumped on every seek, read-ahead of an older generation is discarded
+        self.generation = 0
+
+    def _capture(self):
+        if self.cap is None:
+            self.cap = cv.VideoCapture(self.path)
+            self.next_frame_num = 0
+        return self.cap
+
+    def meta(self):
+        with self.cap_lock:
+            cap = self._capture()
+            fourcc = int(cap.get(cv.CAP_PROP_FOURCC))
+            return {'frame_count': cap.get(cv.CAP_PROP_FRAME_COUNT),
+                    'fps': cap.get(cv.CAP_PROP_FPS),
+                    'width': int(cap.get(cv.CAP_PROP_FRAME_WIDTH)),
+                    'height': int(cap.get(cv.CAP_PROP_FRAME_HEIGHT)),
+                    'codec': fourcc.to_bytes(4, 'little').decode('ascii', errors='replace').strip('\x00')}
+
+    def read(self, num):
+        '''
+        Return the decoded frame num, or None if num is past the end of the video.
+        '''
+        with self.cap_lock:
+            cap = self._capture()
+            if num != self.next_frame_num and not self._seek(cap, num):
+                self.next_frame_num = -1
+                return None
+            ret, frame = cap.read()
+            if not ret:
+                # position is undefined after a failed read, force a seek next time
+                self.next_frame_num = -1
+                return None
+            self.next_frame_num = num + 1
+            return frame
+
+    def _seek(self, cap, num):
+        keyframes = self.keyframes
+        pos = self.next_frame_num
+        if not keyframes:
+            if not 0 <= pos < num <= pos + MAX_GRAB:
+                cap.set(cv.CAP_PROP_POS_FRAMES, num)
+                return True
+            keyframe = pos
+        else:
+            keyframe = keyframes[bisect.bisect_right(keyframes, num) - 1]
+        # within the same GOP ahead of the current position, grabbing forward is cheaper than seeking
+        if not keyframe <= pos < num:
+            cap.set(cv.CAP_PROP_POS_FRAMES, keyframe)
+            pos = keyframe
+        for _ in range(num - pos):
+            if not cap.grab():
+                return False
+        return True
+
+    def read_encoded(self, num, params):
+        frame = self.read(num)
+        if frame is None:
+            return None
+        return encode(frame, params)
+
+    def read_many(self, nums, params):
+        '''
+        Return the encoded frames of nums in order, stopping at the end of the video.
+        '''
+        frames = []
+        for num in nums:
+            frame = self.read_encoded(num, params)
+            if frame is None:
+                break
+            frames.append(frame)
+        return frames
+
+    def release(self):
+        with self.cap_lock:
+            if self.cap is not None:
+                self.cap.release()
+                self.cap = None
+
+
+class DecoderPool:
+    '''
+    Open decoders keyed by (videoId, session), or (videoId, session, 'proxy') for proxies, kept in least-recently-used order.
+    At most max_open decoders are kept open, and decoders unused for idle_timeout seconds are released by evict_idle().
+    Decoding jobs run on a thread pool of `workers` threads. Jobs of one decoder run one at a time,
+    and once max_queued jobs are pending, new ones are rejected with DecoderBusy.
+    Once a decoder is read sequentially, up to prefetch_frames following frames are decoded ahead in the background.
+    '''
+    def __init__(self, max_open=8, idle_timeout=600, workers=4, max_queued=64, prefetch_frames=16):
+        self.max_open = max_open
+        self.idle_timeout = idle_timeout
+        self.max_queued = max_queued
+        self.prefetch_frames = prefetch_frames
+        self.decoders = OrderedDict()
+        self.keyframes = {}
+        self.last_opened = None
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='decoder')
+        self.slots = asyncio.Semaphore(workers)
+        self.pending = 0
+
+    def get(self, key):
+        decoder = self.decoders.get(key)
+        if decoder is not None:
+            self.decoders.move_to_end(key)
+            decoder.last_used = time.monotonic()
+        return decoder
+
+    def open(self, key, path):
+        '''
+        Return the decoder for key, creating it if it is not open yet or if key was opened with another path.
+        '''
+        decoder = self.get(key)
+        if decoder is None or decoder.path != path:
+            if decoder is not None:
+                self._release(self.decoders.pop(key))
+            keyframe_path, keyframes = self.keyframes.get(key[0], (None, None))
+            decoder = VideoDecoder(path, key[0], keyframes if keyframe_path == path else None)
+            self.decoders[key] = decoder
+            while len(self.decoders) > self.max_open:
+                _, lru = self.decoders.popitem(last=False)
+                self._release(lru)
+        return decoder
+
+    def set_keyframes(self, videoId, path, keyframes):
+        self.keyframes[videoId] = (path, keyframes)
+        for key, decoder in self.decoders.items():
+            if key[0] == videoId and decoder.path == path:
+                decoder.keyframes = keyframes
+
+    def check_capacity(self):
+        ''' Raise DecoderBusy if max_queued jobs are already pending. '''
+        if self.pending >= self.max_queued:
+            raise DecoderBusy(f'{self.pending} decoding jobs are already pending')
+
+    @asynccontextmanager
+    async def admit(self, reject=True):
+        '''
+        Count a job against max_queued while it runs, without holding a decoder, e.g. for decoders of their own.
+        With reject, raise DecoderBusy if too many jobs are pending.
+        '''
+        if reject:
+            self.check_capacity()
+        self.pending += 1
+        try:
+            yield
+        finally:
+            self.pending -= 1
+
+    @asynccontextmanager
+    async def reserve(self, decoder):
+        '''
+        Hold the decoder for one job, or raise DecoderBusy if too many jobs are pending.
+        '''
+        async with self.admit():
+            async with decoder.lock:
+                yield
+
+    async def execute(self, fn, *args):
+        async with self.slots:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    async def run(self, decoder, fn, *args):
+        '''
+        Run fn(*args) on the executor once decoder and a worker thread are free.
+        '''
+        async with self.reserve(decoder):
+            return await self.execute(fn, *args)
+
+    async def read_encoded(self, decoder, num, params):
+        async with self.reserve(decoder):
+            # a running prefetch may have decoded the frame while this request waited
+            frame = decoder.readahead.pop(num, None) if params == decoder.readahead_params else None
+            if frame is None:
+                frame = await self.execute(decoder.read_encoded, num, params)
+            return frame
+
+    def follow(self, decoder, num, params):
+        '''
+        Record a request for frame num. Anything but the next frame with the same params cancels the read-ahead.
+        '''
+        if num == decoder.last_requested and params == decoder.readahead_params:
+            return
+        if decoder.last_requested is not None and num == decoder.last_requested + 1 and params == decoder.readahead_params:
+            decoder.streak += 1
+        else:
+            decoder.streak = 0
+            decoder.generation += 1
+            decoder.readahead.clear()
+            decoder.readahead_params = params
+        decoder.last_requested = num
+        for n in [n for n in decoder.readahead if n < num]:
+            del decoder.readahead[n]
+
+    def prefetch(self, decoder):
+        '''
+        Start reading ahead if the decoder has been read sequentially.
+        '''
+        if self.prefetch_frames <= 0 or decoder.streak == 0:
+            return
+        if decoder.prefetch_task is None or decoder.prefetch_task.done():
+            decoder.prefetch_task = asyncio.create_task(
+                self._prefetch(decoder, decoder.generation, decoder.readahead_params))
+
+    async def _prefetch(self, decoder, generation, params):
+        # leave half of the queue to client requests
+        while decoder.generation == generation \
+                and len(decoder.readahead) < self.prefetch_frames \
+                and self.pending < self.max_queued // 2:
+            async with self.reserve(decoder):
+                if decoder.generation != generation:
+                    return
+                # the client may have moved past the decoder position through cached frames
+                num = max(decoder.next_frame_num, decoder.last_requested + 1)
+                frame = await self.execute(decoder.read_encoded, num, params)
+                if frame is None or decoder.generation != generation:
+                    return
+                decoder.readahead[num] = frame
+
+    def _release(self, decoder):
+        decoder.generation += 1
+        decoder.readahead.clear()
+        # a job may still be using the capture, so release it on the executor behind that job
+        self.executor.submit(decoder.release)
+
+    def release(self, videoId):
+        ''' Release every decoder of the video, e.g. after the video is edited or deleted. '''
+        self.keyframes.pop(videoId, None)
+        for key in [k for k in self.decoders if k[0] == videoId]:
+            self._release(self.decoders.pop(key))
+
+    def evict_idle(self):
+        now = time.monotonic()
+        for key in [k for k, d in self.decoders.items() if now - d.last_used > self.idle_timeout]:
+            self._release(self.decoders.pop(key))
+
+    def close(self):
+        for decoder in self.decoders.values():
+            self._release(decoder)
+        self.decoders.clear()
+        self.executor.shutdown(wait=True)
@@ -1,20 +1,31 @@
 import os
+from io import BytesIO
+from tempfile import SpooledTemporaryFile
 from pathlib import Path
-from sys import getsizeof
-from datetime import datetime
 import logging
-from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import Response, JSONResponse
+from fastapi import FastAPI, HTTPException, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import Response, JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-import cv2 as cv
 from typing import List
 from motor import motor_asyncio
-from pymongo import ReturnDocument
+from pymongo import ReturnDocument, ReplaceOne, UpdateOne, DeleteOne
+from pymongo.errors import DuplicateKeyError, BulkWriteError
+from bson import Binary
+import numpy as np
 from configparser import ConfigParser
-from contextlib import asynccontextmanager
-from datamodel import ObjectId, ProjectFromClient, ProjectFromDB, ProjectCollection, BtnGroupFromClient, BtnGroupFromDB, BtnGroupCollectionFromDB, BtnGroupCollectionFromClient, VideoFromClient, VideoFromDB, VideoCollectionFromDB, VideoCollectionFromClient, AdditionalField, AnnotationFromClient, AnnotationCollectionFromClient, AnnotationCollectionFromDB, ProjectAnnotationCollectionFromDB, ProjectAnnotationCollectionFromClient, VideoAnnotationCollectionFromDB, VideoAnnotationCollectionFromClient
+from contextlib import asynccontextmanager, AsyncExitStack
+from datamodel import ObjectId, BtnType, AnnotationPageFromDB, ProjectFromClient, ProjectFromDB, ProjectCollection, BtnGroupFromClient, BtnGroupFromDB, BtnGroupCollectionFromDB, BtnGroupCollectionFromClient, VideoFromClient, VideoFromDB, VideoCollectionFromDB, VideoCollectionFromClient, AdditionalField, AnnotationFromClient, AnnotationFromDB, AnnotationCollectionFromClient, AnnotationCollectionFromDB, ProjectAnnotationCollectionFromDB, ProjectAnnotationCollectionFromClient, VideoAnnotationCollectionFromDB, VideoAnnotationCollectionFromClient
 from customized import getAdditionalData
+from decoder import DecoderPool, DecoderBusy, VideoDecoder, EncodeParams, scan_keyframes
+from cache import ByteLRUCache, deep_sizeof
+from proxy import ProxyBuilder
+from columnar import AnnotationColumns, annotations_from_npz
+from packing import pack, unpack_many
+from writebehind import WriteBehindBuffer
+from timeline import no_runs, runs_from_frames, add_frames, remove_frames, clip_runs, encode_runs, decode_runs
 import asyncio
+import base64
+import orjson
 
 logger = logging.getLogger('video_annotation')
 logger.setLevel(logging.DEBUG)
@@ -23,7 +34,7 @@ log_handler.setFormatter(logging.Formatter('%(asctime)s | %(levelname)s: %(messa
 logger.addHandler(log_handler)
 
 
-def config(section, filename='../database.ini'):
+def config(section, filename='../database.ini', required=True):
     parser = ConfigParser()
     parser.read(filename)
     db_params = {}
@@ -31,11 +42,80 @@ def config(section, filename='../database.ini'):
         params = parser.items(section)
         for param in params:
             db_params[param[0]] = param[1]
-    else:
+    elif required:
         raise Exception(f'Section {section} not found in the {filename} file')
     return db_params
 
 
+def setting(name, default):
+    '''
+    Read an optional server setting from the [server] section of database.ini, converted to the type of default.
+    '''
+    value = getattr(app, 'settings', {}).get(name)
+    if value is None:
+        return default
+    if isinstance(default, bool):
+        return value.lower() in ('1', 'true', 'yes', 'on')
+    return type(default)(value)
+
+
+async def supports_transactions(client):
+    ''' Transactions are only available on replica sets and sharded clusters. '''
+    try:
+        hello = await client.admin.command('hello')
+        return 'setName' in hello or hello.get('msg') == 'isdbgrid'
+    except Exception as e:
+        logger.info(f'Cannot tell whether the database supports transactions: {e}')
+        return False
+
+
+# indexes built at startup, per collection
+INDEXES = {
+    'annotation': [
+        {'keys': [("videoId", 1), ("frameNum", 1), ("_id", 1)], 'name': 'videoId_frameNum_id'},
+        {'keys': [("videoId", 1), ("label", 1), ("frameNum", 1)], 'name': 'videoId_label_frameNum'},
+        # a category label can be set only once per frame of a video
+        {'keys': [("videoId", 1), ("type", 1), ("frameNum", 1), ("label", 1)], 'name': 'unique_category',
+         'unique': True, 'partialFilterExpression': {"type": "category"}},
+    ],
+    'video': [
+        {'keys': [("projectId", 1)], 'name': 'projectId'},
+    ],
+    'btn': [
+        {'keys': [("projectId", 1)], 'name': 'projectId'},
+    ],
+}
+
+
+async def ensure_indexes():
+    '''
+    Build the INDEXES missing from the db in the background, recording the state of each in app.index_status.
+    Indexes that already exist return at once.
+    If unique_category cannot be built, e.g. because of existing duplicates, category inserts are locked instead.
+    '''
+    for collection, indexes in INDEXES.items():
+        for index in indexes:
+            name = f'{collection}.{index["name"]}'
+            options = {k: v for k, v in index.items() if k != 'keys'}
+            app.index_status[name] = {'status': 'building'}
+            try:
+                await app.mongodb[collection].create_index(index['keys'], **options)
+                app.index_status[name] = {'status': 'ready'}
+            except Exception as e:
+                logger.warning(f'Building index {name} failed: {e}')
+                app.index_status[name] = {'status': 'failed', 'error': str(e)}
+            if name == 'annotation.unique_category':
+                app.category_index = app.index_status[name]['status'] == 'ready'
+    summary = ', '.join(f"{name} {state['status']}" for name, state in app.index_status.items())
+    logger.info(f'Indexes: {summary}')
+
+
+async def evict_idle_decoders():
+    while True:
+        await asyncio.sleep(min(60, app.decoders.idle_timeout))
+        app.decoders.evict_idle()
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     try:
@@ -45,8 +125,35 @@ async def lifespan(app: FastAPI):
         app.mongodb = client.get_database(settings['dbname'])
         app.mongodb.project_config = app.mongodb.get_collection("configuration")
         app.mongodb.video = app.mongodb.get_collection("video")
+        app.settings = config('server', required=False)
+        app.transactions = setting('transactions', True) and await supports_transactions(client)
+        app.category_index = False
+        app.index_status = {}
+        index_task = asyncio.create_task(ensure_indexes())
+        app.decoders = DecoderPool(max_open=setting('max_open_decoders', 8),
+                                   idle_timeout=setting('decoder_idle_timeout', 600),
+                                   workers=setting('decoder_workers', 4),
+                                   max_queued=setting('max_queued_frames', 64),
+                                   prefetch_frames=setting('prefetch_frames', 16))
+        app.frame_cache = ByteLRUCache(setting('frame_cache_mb', 256) * 2**20)
+        app.keyframe_builds = {}
+        app.packed_schemas = {}
+        app.additional_data = ByteLRUCache(setting('additional_data_cache_mb', 512) * 2**20, sizeof=deep_sizeof)
+        app.additional_data_loads = {}
+        app.proxies = ProxyBuilder(setting('proxy_dir', '../cache/proxy'), width=setting('proxy_width', 320))
+        app.proxies.start()
+        evict_task = asyncio.create_task(evict_idle_decoders())
+        app.annotation_writes = WriteBehindBuffer(write_annotations_mongo,
+                                                  interval=setting('annotation_flush_ms', 100) / 1000,
+                                                  max_ops=setting('annotation_flush_ops', 500))
+        app.annotation_writes.start()
 
         yield
+        await app.annotation_writes.close()
+        index_task.cancel()
+        evict_task.cancel()
+        app.proxies.close()
+        app.decoders.close()
         client.close()
     except Exception as e:
         logger.info('error', e)
@@ -85,6 +192,16 @@ async def testHandler():
         return error_handler(e)
 
 
+@app.get("/api/indexes")
+async def getIndexesHandler():
+    logger.debug("Get: /api/indexes")
+    try:
+        return app.index_status
+    except Exception as e:
+        print('error')
+        return error_handler(e)
+
+
 @app.post(
     "/api/project",
     response_description="Add new project",
@@ -229,14 +346,11 @@ async def postProjectBtnHandler(btnGroupColletion: BtnGroupCollectionFromClient)
     try:
         projectId = btnGroupColletion.projectId
         btnGroups = btnGroupColletion.btnGroups
-        delete_res = await delete_project_objs_mongo(projectId, 'btn')
-        insert_res = 0
-        if len(btnGroups) > 0:
-            insert_res = await post_project_objs_mongo(btnGroups, 'btn')
-        if insert_res == len(btnGroups):
-            return {'success': f'deleted {delete_res.deleted_count}, added {insert_res} btn groups'}
+        saved, deleted = await run_transaction(lambda session: save_project_objs_mongo(btnGroups, 'btn', projectId, session))
+        if saved == len(btnGroups):
+            return {'success': f'deleted {deleted}, added {saved} btn groups'}
         else:
-            return {'error': f'deleted {delete_res.deleted_count}, added {insert_res} btn groups, the uploaded data has {len(btnGroups)} btn groups'}
+            return {'error': f'deleted {deleted}, added {saved} btn groups, the uploaded data has {len(btnGroups)} btn groups'}
     except Exception as e:
         print('error')
         return error_handler(e)
@@ -266,7 +380,10 @@ async def postVideoHandler(video_config_obj: VideoFromClient):
 async def editVideoHandler(new_video_obj: VideoFromClient):
     logger.debug("Put: /api/video")
     try:
+        release_video(new_video_obj.videoId)
         res = await edit_one_obj_mongo(new_video_obj, 'video')
+        # the path may have changed, probe the file again on the next /api/videometa
+        await app.mongodb.video.update_one({"_id": new_video_obj.videoId}, {"$unset": {"meta": ""}})
         if res.get('error') is not None:
             post_res = await post_one_obj_mongo(new_video_obj, 'video')
             if post_res.get('info') is not None:
@@ -287,6 +404,8 @@ async def deleteVideoHandler(id: ObjectId):
     try:
         deleteAnnotationRes = await delete_project_objs_mongo(None, 'annotation', [id])
         deleteVideoRes = await delete_one_obj_mongo(id, 'video')
+        release_video(id)
+        await app.mongodb.keyframe.delete_one({"_id": id})
         if deleteVideoRes.get('error') is not None:
             raise HTTPException(status_code=500, detail=f'Deleting video failed.')
         return {'info': f'Deleted 1 video and {deleteAnnotationRes.deleted_count} annotations'}
@@ -329,62 +448,182 @@ async def postProjectVideoHandler(videoColletion: VideoCollectionFromClient):
     try:
         projectId = videoColletion.projectId
         videos = videoColletion.videos
-        delete_res = await delete_project_objs_mongo(projectId, 'video')
-        insert_res = 0
-        if len(videos) > 0:
-            insert_res = await post_project_objs_mongo(videos, 'video')
-        if insert_res == len(videos):
-            return {'success': f'deleted {delete_res.deleted_count}, added {insert_res} videos'}
+        for video in videos:
+            release_video(video.videoId)
+        saved, deleted = await run_transaction(lambda session: save_project_objs_mongo(videos, 'video', projectId, session))
+        if setting('build_proxies', False):
+            for video in videos:
+                app.proxies.submit(video.videoId, video.path)
+        if saved == len(videos):
+            return {'success': f'deleted {deleted}, added {saved} videos'}
         else:
-            return {'error': f'deleted {delete_res.deleted_count}, added {insert_res} videos, the uploaded data has {len(videos)} videos'}
+            return {'error': f'deleted {deleted}, added {saved} videos, the uploaded data has {len(videos)} videos'}
     except Exception as e:
         print('error')
         return error_handler(e)
 
 
-cap = None
-next_frame_num = 0
+def release_video(videoId):
+    ''' Drop the open decoders and cached frames of a video whose file may have changed. '''
+    app.decoders.release(videoId)
+    app.frame_cache.invalidate(lambda key: key[0] == videoId)
+
+
+async def get_decoder(videoId, session=None):
+    '''
+    Return the open decoder of the video for the session, opening it if it has been evicted from the pool.
+    Without videoId, the video most recently opened through /api/videometa is used.
+    '''
+    if videoId is None:
+        if app.decoders.last_opened is None:
+            raise HTTPException(status_code=400, detail='No video opened')
+        videoId, session = app.decoders.last_opened
+    key = (videoId, session)
+    decoder = app.decoders.get(key)
+    if decoder is None:
+        path = await find_video_path(videoId)
+        decoder = app.decoders.open(key, path)
+        await load_keyframe_index(videoId, path)
+    return decoder
+
+
+def proxy_path_for(videoId, path, params):
+    '''
+    Return the path of the proxy of the video if it is built and large enough for params.
+    Only requests for a width no larger than the proxy's, without a height, are served from proxies.
+    '''
+    if params.width is None or params.height is not None or params.width > app.proxies.width:
+        return None
+    return app.proxies.ready(videoId, path)
+
+
+async def find_video_path(videoId):
+    res = await app.mongodb.video.find_one({"_id": videoId}, { "_id": 0, "path": 1 })
+    if res is None:
+        raise HTTPException(status_code=404, detail='Video path not found')
+    if not os.path.exists(res['path']):
+        raise HTTPException(status_code=404, detail='Video file is not found')
+    return res['path']
+
+
+async def load_keyframe_index(videoId, path):
+    '''
+    Hand the keyframe index of the video file to its decoders.
+    The index is read from the db, or built in the background the first time the file is opened.
+    '''
+    if videoId in app.decoders.keyframes or videoId in app.keyframe_builds:
+        return
+    stat = os.stat(path)
+    res = await app.mongodb.keyframe.find_one({"_id": videoId})
+    if res is not None and res['path'] == path and res['size'] == stat.st_size and res['mtime'] == stat.st_mtime:
+        keyframes = np.frombuffer(res['keyframes'], dtype=np.int32).tolist()
+        app.decoders.set_keyframes(videoId, path, keyframes)
+    else:
+        app.keyframe_builds[videoId] = asyncio.create_task(build_keyframe_index(videoId, path, stat))
+
+
+async def build_keyframe_index(videoId, path, stat):
+    try:
+        keyframes = await asyncio.get_running_loop().run_in_executor(None, scan_keyframes, path)
+        if keyframes is None:
+            logger.info(f'No keyframe information for {path}, seeking by frame number')
+            keyframes = []
+        await app.mongodb.keyframe.replace_one(
+            {"_id": videoId},
+            {"path": path, "size": stat.st_size, "mtime": stat.st_mtime,
+             "keyframes": Binary(np.asarray(keyframes, dtype=np.int32).tobytes())},
+            upsert=True)
+        app.decoders.set_keyframes(videoId, path, keyframes)
+        logger.debug(f'Built keyframe index of {path}: {len(keyframes)} key frames')
+    except Exception as e:
+        logger.error(f'Building keyframe index of {path} failed: {e}')
+    finally:
+        app.keyframe_builds.pop(videoId, None)
+
+
+async def run_decoder(job):
+    try:
+        return await job
+    except DecoderBusy as e:
+        raise HTTPException(status_code=503, detail=f'Server is busy decoding frames: {e}')
+
+
+def check_decoders():
+    '''
+    Raise a 503 like run_decoder if too many decoding jobs are pending, before starting a stream of them.
+    The jobs of a started stream are counted as pending but not rejected, not to cut it off halfway.
+    '''
+    try:
+        app.decoders.check_capacity()
+    except DecoderBusy as e:
+        raise HTTPException(status_code=503, detail=f'Server is busy decoding frames: {e}')
+
+
+async def read_frame(decoder, num, params):
+    ''' Return frame num encoded with params, from the frame cache or the read-ahead if possible. '''
+    app.decoders.follow(decoder, num, params)
+    cache_key = (decoder.videoId, num, params)
+    frame = app.frame_cache.get(cache_key)
+    if frame is None:
+        frame = await run_decoder(app.decoders.read_encoded(decoder, num, params))
+        if frame is not None:
+            app.frame_cache.put(cache_key, frame)
+    app.decoders.prefetch(decoder)
+    return frame
+
+
+def encode_params(format, width, height, quality):
+    params = EncodeParams(format.lower(), width, height, quality)
+    try:
+        params.validate()
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return params
+
 
 @app.get("/api/videometa")
-async def getVideoMetaHandler(id: ObjectId):
+async def getVideoMetaHandler(id: ObjectId, session: str = None):
     logger.debug(f"Get: /api/videometa?id={id}")
     try:
-        res = await app.mongodb.video.find_one({"_id": id}, { "_id": 0, "path": 1 })
+        res = await app.mongodb.video.find_one({"_id": id}, { "_id": 0, "path": 1, "meta": 1 })
         if res is None:
             raise HTTPException(status_code=404, detail='Video path not found')
         path = res['path']
-
-        global cap, next_frame_num
         if not os.path.exists(path):
             raise HTTPException(status_code=404, detail='Video file is not found')
-        if cap:
-            cap.release()
-        cap = cv.VideoCapture(path)
-        frame_count = cap.get(cv.CAP_PROP_FRAME_COUNT)
-        fps = cap.get(cv.CAP_PROP_FPS)
 
-        next_frame_num = 0
-        return {'frame_count': frame_count, 'fps': fps}
+        decoder = app.decoders.open((id, session), path)
+        app.decoders.last_opened = (id, session)
+        await load_keyframe_index(id, path)
+        # probe the file only if it changed since the stored metadata was taken
+        stat = os.stat(path)
+        meta = res.get('meta')
+        if meta is None or meta['size'] != stat.st_size or meta['mtime'] != stat.st_mtime:
+            meta = await run_decoder(app.decoders.run(decoder, decoder.meta))
+            meta.update({'size': stat.st_size, 'mtime': stat.st_mtime})
+            await app.mongodb.video.update_one({"_id": id}, {"$set": {"meta": meta}})
+        return meta
     except Exception as e:
         print('error')
         return error_handler(e)
 
 
 @app.get('/api/frame')
-async def getFrame(num: int):
-    logger.debug(f'api/frame?num={num}')
+async def getFrame(num: int, videoId: ObjectId = None, session: str = None,
+                   width: int = None, height: int = None, quality: int = None, format: str = 'jpg'):
+    logger.debug(f'api/frame?num={num}&videoId={videoId}')
     try:
         if num < 0:
             raise HTTPException(status_code=416, detail='Frame number out of bound')
-        global next_frame_num
-        if num==0 or num!=next_frame_num:
-            cap.set(cv.CAP_PROP_POS_FRAMES, num)
-        ret, frame = cap.read()
-        next_frame_num = num + 1
-        if ret:
-            ret, frame_1d = cv.imencode('.jpg', frame)
-            headers = {'Content-Disposition': f'inline; filename=f_{num}.jpg'}
-            return Response(frame_1d.tobytes() , headers=headers, media_type='image/jpg')
+        params = encode_params(format, width, height, quality)
+        decoder = await get_decoder(videoId, session)
+        proxy_path = proxy_path_for(decoder.videoId, decoder.path, params)
+        if proxy_path is not None:
+            decoder = app.decoders.open((decoder.videoId, session, 'proxy'), proxy_path)
+        frame = await read_frame(decoder, num, params)
+        if frame is not None:
+            headers = {'Content-Disposition': f'inline; filename=f_{num}.{params.format}'}
+            return Response(frame, headers=headers, media_type=params.media_type)
         else:
             raise HTTPException(status_code=416, detail=f'Frame {num+1} reached video end')
     except Exception as e:
@@ -392,6 +631,231 @@ async def getFrame(num: int):
         return error_handler(e)
 
 
+FRAME_BOUNDARY = 'frame'
+
+@app.get('/api/frames')
+async def getFramesHandler(videoId: ObjectId, start: int, end: int, step: int = 1,
+                           width: int = None, height: int = None, quality: int = None, format: str = 'jpg'):
+    '''
+    Stream frames start, start+step, ... up to end (inclusive) as a multipart/mixed response of image parts,
+    each with an X-Frame-Num header. The frames are decoded in one pass on a capture of their own.
+    '''
+    logger.debug(f'api/frames?videoId={videoId}&start={start}&end={end}&step={step}&width={width}&height={height}')
+    try:
+        if start < 0 or end < start or step < 1:
+            raise HTTPException(status_code=416, detail='Invalid frame range')
+        params = encode_params(format, width, height, quality)
+        # the length of a range is computed without building it, check it before listing the frames
+        nums = range(start, end + 1, step)
+        if len(nums) > setting('max_batch_frames', 1000):
+            raise HTTPException(status_code=400, detail=f'Too many frames requested: {len(nums)}')
+        nums = list(nums)
+        path = await find_video_path(videoId)
+        proxy_path = proxy_path_for(videoId, path, params)
+        if proxy_path is not None:
+            decoder = VideoDecoder(proxy_path, videoId)
+        else:
+            await load_keyframe_index(videoId, path)
+            _, keyframes = app.decoders.keyframes.get(videoId, (None, None))
+            decoder = VideoDecoder(path, videoId, keyframes)
+        check_decoders()
+        return StreamingResponse(stream_frames(decoder, nums, params),
+                                 media_type=f'multipart/mixed; boundary={FRAME_BOUNDARY}')
+    except Exception as e:
+        print('error')
+        return error_handler(e)
+
+
+async def stream_frames(decoder, nums, params, chunk_size=8):
+    try:
+        for i in range(0, len(nums), chunk_size):
+            chunk = nums[i:i+chunk_size]
+            async with app.decoders.admit(reject=False):
+                frames = await app.decoders.execute(decoder.read_many, chunk, params)
+            for num, frame in zip(chunk, frames):
+                yield (f'--{FRAME_BOUNDARY}\r\n'
+                       f'Content-Type: {params.media_type}\r\n'
+                       f'Content-Length: {len(frame)}\r\n'
+                       f'X-Frame-Num: {num}\r\n\r\n').encode() + frame + b'\r\n'
+            if len(frames) < len(chunk):
+                break
+        yield f'--{FRAME_BOUNDARY}--\r\n'.encode()
+    finally:
+        # the client may disconnect while a chunk is decoding, release behind it
+        app.decoders.executor.submit(decoder.release)
+
+
+@app.websocket('/api/stream')
+async def streamHandler(websocket: WebSocket, videoId: ObjectId, start: int = 0, fps: float = None,
+                        width: int = None, height: int = None, quality: int = None, format: str = 'jpg'):
+    '''
+    Play the video from frame start over a WebSocket, at fps or the native frame rate.
+    Each frame is sent as a binary message of the 4 byte big-endian frame number followed by the image.
+    The client controls playback with JSON messages:
+        {"action": "play"}, {"action": "pause"}, {"action": "seek", "frameNum": 100}, {"action": "rate", "fps": 15}
+    At the end of the video, playback pauses and {"info": "video end", "frameNum": n} is sent.
+    '''
+    logger.debug(f'ws api/stream?videoId={videoId}&start={start}&fps={fps}')
+    await websocket.accept()
+    decoder = None
+    try:
+        params = encode_params(format, width, height, quality)
+        if fps is not None and fps <= 0:
+            raise HTTPException(status_code=400, detail='fps should be positive')
+        path = await find_video_path(videoId)
+        await load_keyframe_index(videoId, path)
+        _, keyframes = app.decoders.keyframes.get(videoId, (None, None))
+        check_decoders()
+        decoder = VideoDecoder(path, videoId, keyframes)
+        if fps is None:
+            async with app.decoders.admit(reject=False):
+                fps = (await app.decoders.execute(decoder.meta))['fps'] or 30
+        state = {'frameNum': max(start, 0), 'fps': fps, 'playing': True, 'refresh': False}
+        changed = asyncio.Event()
+        sender = asyncio.create_task(send_stream_frames(websocket, decoder, params, state, changed))
+        sender.add_done_callback(lambda done: stream_sender_done(websocket, done))
+        try:
+            while True:
+                message = await websocket.receive_json()
+                action = message.get('action')
+                if action == 'play':
+                    state['playing'] = True
+                elif action == 'pause':
+                    state['playing'] = False
+                elif action == 'seek' and int(message.get('frameNum', -1)) >= 0:
+                    state['frameNum'] = int(message['frameNum'])
+                    state['refresh'] = True
+                elif action == 'rate' and float(message.get('fps', 0)) > 0:
+                    state['fps'] = float(message['fps'])
+                else:
+                    logger.debug(f'Ignored stream message {message}')
+                changed.set()
+        finally:
+            sender.cancel()
+    except WebSocketDisconnect:
+        pass
+    except Exception as e:
+        await close_stream(websocket, e)
+    finally:
+        if decoder is not None:
+            app.decoders.executor.submit(decoder.release)
+
+
+async def close_stream(websocket, e):
+    ''' Send the error to the client and close the stream. '''
+    logger.error(e)
+    detail = e.detail if isinstance(e, HTTPException) else ', '.join(str(arg) for arg in e.args)
+    try:
+        await websocket.send_json({'error': detail})
+        await websocket.close(code=1011)
+    except Exception:
+        # the client is already gone
+        pass
+
+
+def stream_sender_done(websocket, sender):
+    # the receiving loop does not see errors of the sender, close the stream for it
+    if sender.cancelled() or sender.exception() is None or isinstance(sender.exception(), WebSocketDisconnect):
+        return
+    asyncio.create_task(close_stream(websocket, sender.exception()))
+
+
+async def send_stream_frames(websocket, decoder, params, state, changed):
+    loop = asyncio.get_running_loop()
+    next_time = loop.time()
+    while True:
+        if not state['playing'] and not state['refresh']:
+            await changed.wait()
+            changed.clear()
+            next_time = loop.time()
+            continue
+        changed.clear()
+        # a paused seek shows the new frame once
+        state['refresh'] = False
+        num = state['frameNum']
+        async with app.decoders.admit(reject=False):
+            frame = await app.decoders.execute(decoder.read_encoded, num, params)
+        if frame is None:
+            state['playing'] = False
+            await websocket.send_json({'info': 'video end', 'frameNum': num})
+            continue
+        await websocket.send_bytes(num.to_bytes(4, 'big') + frame)
+        if state['frameNum'] == num and state['playing']:
+            state['frameNum'] = num + 1
+        next_time += 1 / state['fps']
+        delay = next_time - loop.time()
+        if delay > 0:
+            try:
+                await asyncio.wait_for(changed.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+        else:
+            # running late, do not try to catch up with a burst
+            next_time = loop.time()
+
+
+@app.get('/api/proxy')
+async def getProxyHandler(videoId: ObjectId):
+    logger.debug(f'Get: /api/proxy?videoId={videoId}')
+    try:
+        path = await find_video_path(videoId)
+        return app.proxies.get_status(videoId, path)
+    except Exception as e:
+        print('error')
+        return error_handler(e)
+
+@app.post('/api/proxy')
+async def postProxyHandler(videoId: ObjectId):
+    logger.debug(f'Post: /api/proxy?videoId={videoId}')
+    try:
+        path = await find_video_path(videoId)
+        return app.proxies.submit(videoId, path)
+    except Exception as e:
+        print('error')
+        return error_handler(e)
+
+@app.get('/api/proxies')
+async def getProjectProxyHandler(projectId: ObjectId):
+    logger.debug(f'Get: /api/proxies?projectId={projectId}')
+    try:
+        videos = await app.mongodb.video.find({"projectId": projectId}, {"path": 1}).to_list(None)
+        return {v['_id']: app.proxies.get_status(v['_id'], v['path']) for v in videos}
+    except Exception as e:
+        print('error')
+        return error_handler(e)
+
+@app.post('/api/proxies')
+async def postProjectProxyHandler(projectId: ObjectId):
+    logger.debug(f'Post: /api/proxies?projectId={projectId}')
+    try:
+        videos = await app.mongodb.video.find({"projectId": projectId}, {"path": 1}).to_list(None)
+        return {v['_id']: app.proxies.submit(v['_id'], v['path']) for v in videos if os.path.exists(v['path'])}
+    except Exception as e:
+        print('error')
+        return error_handler(e)
+
+
+@app.get('/api/framecache')
+async def getFrameCacheHandler():
+    logger.debug('Get: /api/framecache')
+    try:
+        return app.frame_cache.stats()
+    except Exception as e:
+        print('error')
+        return error_handler(e)
+
+@app.delete('/api/framecache')
+async def deleteFrameCacheHandler():
+    logger.debug('Delete: /api/framecache')
+    try:
+        entries = len(app.frame_cache.items)
+        app.frame_cache.clear()
+        return {'info': f'deleted {entries} cached frames'}
+    except Exception as e:
+        print('error')
+        return error_handler(e)
+
+
 @app.post(
     "/api/projectannotation",
     response_description="Add new annotations of a project",
@@ -399,17 +863,9 @@ async def getFrame(num: int):
 async def postProjectAnnotationHandler(annotationCollection: ProjectAnnotationCollectionFromClient):
     logger.debug("Post: /api/projectannotation")
     try:
-        projectId = annotationCollection.projectId
         videoIds = annotationCollection.videos
         annotations = annotationCollection.annotations
-        delete_res = await delete_project_objs_mongo(projectId, 'annotation', videoIds)
-        insert_res = 0
-        if len(annotations) > 0:
-            insert_res = await post_project_objs_mongo(annotations, 'annotation', videoIds)
-        if insert_res == len(annotations):
-            return {'success': f'deleted {delete_res.deleted_count}, added {insert_res} annotations'}
-        else:
-            return {'error': f'deleted {delete_res.deleted_count}, added {insert_res} annotations, the uploaded data has {len(annotations)} annotations'}
+        return await save_annotations([anno.model_dump(by_alias=True) for anno in annotations], videoIds)
     except Exception as e:
         print('error')
         return error_handler(e)
@@ -423,26 +879,57 @@ async def getProjectAnnotationHandler(projectId: ObjectId):
     try:
         videoList = await app.mongodb.video.find({"projectId": projectId}, {"_id": 1}).to_list(None)
         videoIdList = [v['_id'] for v in videoList]
-        res = await app.mongodb.annotation.find({"videoId": {"$in": videoIdList}}).sort("frameNum", 1).to_list(None)
-        return ProjectAnnotationCollectionFromDB(projectId=projectId, videos=videoIdList, annotations=res)
+        await app.annotation_writes.flush()
+        return stream_annotations({'projectId': projectId, 'videos': videoIdList}, {"videoId": {"$in": videoIdList}})
     except Exception as e:
         print('error')
         return error_handler(e)
 
+# renames _id the way AnnotationFromDB does, so that raw documents can be sent as they are
+ANNOTATION_PROJECTION = {"_id": 0, "id": "$_id", "videoId": 1, "frameNum": 1, "type": 1, "label": 1,
+                         "color": 1, "data": 1, "groupIndex": 1, "isCrowd": 1, "pathes": 1, "packed": 1}
+
+def stream_annotations(header, query):
+    '''
+    Stream {**header, "annotations": [...]} for the annotations matching query, sorted by frameNum,
+    writing one batch at a time so that memory use is bounded by the batch size rather than by the number of annotations.
+    Annotations are validated when they are saved, so with trusted_reads the documents are projected in the db
+    and serialized by orjson without going through the pydantic models again.
+    '''
+    batch_size = setting('annotation_batch_size', 1000)
+    if setting('trusted_reads', True):
+        cursor = app.mongodb.annotation.aggregate(
+            [{"$match": query}, {"$sort": {"frameNum": 1}}, {"$project": ANNOTATION_PROJECTION}],
+            batchSize=batch_size)
+        serialize = lambda batch: orjson.dumps(batch, default=str)[1:-1]
+    else:
+        cursor = app.mongodb.annotation.find(query).sort("frameNum", 1).batch_size(batch_size)
+        serialize = lambda batch: b','.join(AnnotationFromDB.model_validate(doc).model_dump_json().encode() for doc in batch)
+
+    async def generate():
+        yield orjson.dumps(header)[:-1] + b',"annotations":['
+        separator = b''
+        batch = []
+        async for doc in cursor:
+            batch.append(doc)
+            if len(batch) == batch_size:
+                yield separator + serialize(await expand_annotations(batch))
+                separator = b','
+                batch = []
+        if len(batch) > 0:
+            yield separator + serialize(await expand_annotations(batch))
+        yield b']}'
+
+    return StreamingResponse(generate(), media_type='application/json')
+
+
 @app.post("/api/videoannotation")
 async def postVideoAnnotationHandler(annotationCollection: VideoAnnotationCollectionFromClient):
     logger.debug("Post: /api/videoannotation")
     try:
         videoId = annotationCollection.videoId
         annotations = annotationCollection.annotations
-        delete_res = await delete_video_annotation_mongo(videoId)
-        insert_res = 0
-        if len(annotations) > 0:
-            insert_res = await post_video_annotations_mongo(annotations)
-        if insert_res == len(annotations):
-            return {'success': f'deleted {delete_res.deleted_count}, added {insert_res} annotations'}
-        else:
-            return {'error': f'deleted {delete_res.deleted_count}, added {insert_res} annotations, the uploaded data has {len(annotations)} annotations'}
+        return await save_annotations([anno.model_dump(by_alias=True) for anno in annotations], [videoId])
     except Exception as e:
         print('error')
         return error_handler(e)
@@ -454,8 +941,121 @@ async def postVideoAnnotationHandler(annotationCollection: VideoAnnotationCollec
 async def getVideoAnnotationHandler(videoId: ObjectId):
     logger.debug(f"Get: /api/videoannotation?videoId={videoId}")
     try:
-        res = await app.mongodb.annotation.find({"videoId": ObjectId(videoId)}).sort("frameNum", 1).to_list(None)
-        return VideoAnnotationCollectionFromDB(videoId=videoId, annotations=res)
+        await app.annotation_writes.flush()
+        return stream_annotations({'videoId': videoId}, {"videoId": ObjectId(videoId)})
+    except Exception as e:
+        print('error')
+        return error_handler(e)
+
+
+@app.post("/api/annotation",
+          response_description="Add or replace one annotation")
+async def postAnnotationHandler(annotation: AnnotationFromClient, wait: bool = True):
+    '''
+    The annotation is written with the other single annotation edits at the next flush of the write buffer,
+    and edits of the same annotation until then are coalesced into the last one.
+    With wait, respond once the annotation is written, otherwise as soon as it is queued.
+    '''
+    logger.debug(f"Post: /api/annotation?wait={wait}")
+    try:
+        doc = annotation.model_dump(by_alias=True)
+        await queue_annotation_write(doc['_id'], doc, wait)
+        return {'success': f'Saved annotation {doc["_id"]}'} if wait else {'info': f'Queued annotation {doc["_id"]}'}
+    except Exception as e:
+        print('error')
+        return error_handler(e)
+
+@app.delete("/api/annotation",
+            response_description="Delete one annotation")
+async def deleteAnnotationHandler(id: ObjectId, wait: bool = True):
+    logger.debug(f"Delete: /api/annotation?id={id}&wait={wait}")
+    try:
+        await queue_annotation_write(id, None, wait)
+        return {'success': f'Deleted annotation {id}'} if wait else {'info': f'Queued deletion of annotation {id}'}
+    except Exception as e:
+        print('error')
+        return error_handler(e)
+
+async def queue_annotation_write(id, doc, wait):
+    written = app.annotation_writes.submit(id, doc)
+    if wait:
+        error = await written
+        if error is not None:
+            raise error if isinstance(error, HTTPException) else HTTPException(status_code=500, detail=str(error))
+    else:
+        # nobody awaits the result, so log the error rather than losing it
+        written.add_done_callback(lambda done: log_annotation_write(id, done))
+
+
+def log_annotation_write(id, written):
+    if written.cancelled() or written.result() is None:
+        return
+    error = written.result()
+    detail = error.detail if isinstance(error, HTTPException) else str(error)
+    logger.error(f'Writing annotation {id} failed: {detail}')
+
+
+@app.get("/api/annotationnpz",
+         response_description="Export the annotations of a project or a video as an NPZ archive of columns")
+async def getAnnotationNpzHandler(projectId: ObjectId = None, videoId: ObjectId = None, compressed: bool = False):
+    logger.debug(f"Get: /api/annotationnpz?projectId={projectId}&videoId={videoId}&compressed={compressed}")
+    try:
+        if (projectId is None) == (videoId is None):
+            raise HTTPException(status_code=400, detail='Give either projectId or videoId')
+        if projectId is not None:
+            videoList = await app.mongodb.video.find({"projectId": projectId}, {"_id": 1}).to_list(None)
+            videoIds = [v['_id'] for v in videoList]
+            filename = f'{projectId}_annotations.npz'
+        else:
+            videoIds = [videoId]
+            filename = f'{videoId}_annotations.npz'
+        await app.annotation_writes.flush()
+        batch_size = setting('annotation_batch_size', 1000)
+        cursor = app.mongodb.annotation.find({"videoId": {"$in": videoIds}}).sort("frameNum", 1).batch_size(batch_size)
+        loop = asyncio.get_running_loop()
+        # the documents are turned into columns a batch at a time, not to hold them all besides the columns
+        columns = AnnotationColumns()
+        batch = []
+        async for doc in cursor:
+            batch.append(doc)
+            if len(batch) == batch_size:
+                await loop.run_in_executor(None, columns.add, await expand_annotations(batch))
+                batch = []
+        if len(batch) > 0:
+            await loop.run_in_executor(None, columns.add, await expand_annotations(batch))
+        # np.savez seeks back into the archive, so write it aside and stream it from there
+        file = SpooledTemporaryFile(max_size=64 * 2**20)
+        await loop.run_in_executor(None, columns.save, videoIds, file, compressed)
+        del columns
+        file.seek(0)
+
+        def chunks():
+            with file:
+                while chunk := file.read(2**20):
+                    yield chunk
+
+        return StreamingResponse(chunks(), media_type='application/octet-stream',
+                                 headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+    except Exception as e:
+        print('error')
+        return error_handler(e)
+
+@app.post("/api/annotationnpz",
+          response_description="Replace the annotations of the videos of an NPZ archive with its annotations")
+async def postAnnotationNpzHandler(request: Request):
+    '''
+    The body is an archive as exported by GET /api/annotationnpz. Its arrays are checked as a whole,
+    not each annotation through the data model, so large archives load fast.
+    '''
+    logger.debug("Post: /api/annotationnpz")
+    try:
+        body = await request.body()
+        try:
+            videoIds, docs = await asyncio.get_running_loop().run_in_executor(None, annotations_from_npz, BytesIO(body))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        del body
+        return await save_annotations(docs, videoIds)
     except Exception as e:
         print('error')
         return error_handler(e)
@@ -470,25 +1070,87 @@ async def deleteProjectAnnotationHandler(projectId: ObjectId):
     try:
         project_videos = await app.mongodb.video.find({"projectId": projectId}, {"_id": 1}).to_list(None)
         if len(project_videos) > 0:
-            res = await delete_project_objs_mongo(projectId, 'annotation', project_videos)
+            res = await delete_project_objs_mongo(projectId, 'annotation', [v['_id'] for v in project_videos])
             return {'info': f'deleted {res.deleted_count} annotations'}
         return {'info': 'no anntation found for this project'}
     except Exception as e:
         print('error')
         return error_handler(e)
 
+@app.get("/api/annotationwindow",
+         response_description="Find annotations of a video in a frame window, one page at a time",
+         response_model=AnnotationPageFromDB,
+         response_model_by_alias=False)
+async def getAnnotationWindowHandler(videoId: ObjectId, start: int, end: int, type: BtnType = None, labels: str = None,
+                                     limit: int = 1000, after: str = None):
+    '''
+    Annotations of frames start to end (inclusive), sorted by frameNum and id, optionally of one type and some labels (separated by @@).
+    When more than limit annotations match, next is the token to pass as after to get the following page.
+    '''
+    logger.debug(f"Get: /api/annotationwindow?videoId={videoId}&start={start}&end={end}&type={type}&labels={labels}&limit={limit}&after={after}")
+    try:
+        if limit < 1 or limit > 10000:
+            raise HTTPException(status_code=400, detail='limit should be between 1 and 10000')
+        await app.annotation_writes.flush()
+        query = {"videoId": videoId, "frameNum": {"$gte": start, "$lte": end}}
+        if type is not None:
+            query['type'] = type
+        if labels is not None:
+            query['label'] = {"$in": labels.split('@@')}
+        if after is not None:
+            frameNum, id = decode_page_token(after)
+            query['$or'] = [{"frameNum": {"$gt": frameNum}}, {"frameNum": frameNum, "_id": {"$gt": id}}]
+        res = await app.mongodb.annotation.find(query) \
+            .sort([("frameNum", 1), ("_id", 1)]) \
+            .limit(limit + 1) \
+            .to_list(None)
+        next = None
+        if len(res) > limit:
+            res = res[:limit]
+            next = encode_page_token(res[-1]['frameNum'], res[-1]['_id'])
+        res = await expand_annotations(res)
+        return AnnotationPageFromDB(videoId=videoId, annotations=res, next=next)
+    except Exception as e:
+        print('error')
+        return error_handler(e)
+
+
+def encode_page_token(frameNum, id):
+    return base64.urlsafe_b64encode(orjson.dumps([frameNum, id])).decode()
+
+def decode_page_token(token):
+    try:
+        frameNum, id = orjson.loads(base64.urlsafe_b64decode(token.encode()))
+        return int(frameNum), id
+    except Exception:
+        raise HTTPException(status_code=400, detail='Invalid page token')
+
+
 @app.get("/api/annotationforchart",
          response_description="Find category annotations of a group of labels",
          )
-async def getAnnotationForChartHandler(videoId: ObjectId, frameNum: int, labels: str, range: int):
-    logger.debug(f"Get: /api/annotationforchart?videoId={videoId}&frameNum={frameNum}&labels={labels}&range={range}")
+async def getAnnotationForChartHandler(videoId: ObjectId, frameNum: int = None, labels: str = None, range: int = None,
+                                       format: str = 'annotations'):
+    '''
+    format=annotations: the annotations of the labels (separated by @@) on frames frameNum-range to frameNum+range.
+    format=timeline: {"videoId", "start", "end", "labels": {label: [[start, end], ...]}}, the runs of frames each label is set on,
+    from the timeline of the video. Without frameNum and range, the runs of the whole video. Without labels, every label.
+    '''
+    logger.debug(f"Get: /api/annotationforchart?videoId={videoId}&frameNum={frameNum}&labels={labels}&range={range}&format={format}")
     try:
+        await app.annotation_writes.flush()
+        if format == 'timeline':
+            return await get_chart_timeline(videoId, frameNum, labels, range)
+        if format != 'annotations':
+            raise HTTPException(status_code=400, detail='format should be annotations or timeline')
+        if frameNum is None or labels is None or range is None:
+            raise HTTPException(status_code=400, detail='frameNum, labels and range are required')
         labels_list = labels.split('@@')
         annotation_list = await app.mongodb.annotation.find( \
             {"videoId": videoId, \
              "frameNum": {"$gte": frameNum-range, "$lte": frameNum+range}, \
              "label": {"$in": labels_list}}, \
-             {"data": 0, "groupIndex": 0, "isCrowd": 0, "pathes": 0}) \
+             {"data": 0, "groupIndex": 0, "isCrowd": 0, "pathes": 0, "packed": 0}) \
             .sort({"frameNum": 1}) \
             .to_list(None)
         return annotation_list
@@ -497,16 +1159,97 @@ async def getAnnotationForChartHandler(videoId: ObjectId, frameNum: int, labels:
         return error_handler(e)
 
 
+@app.get("/api/annotationsummary",
+         response_description="Summarize the annotations of a video per label, computed in the database")
+async def getAnnotationSummaryHandler(videoId: ObjectId, bins: int = 100, type: BtnType = None, labels: str = None,
+                                      frameCount: int = None):
+    '''
+    Per label (optionally of one type and some labels separated by @@):
+    count: number of annotations, frames: number of frames annotated, coverage: frames / frameCount,
+    first and last: first and last frame annotated, occupancy: for each of the bins, the fraction of its frames annotated.
+    frameCount defaults to the frame count of the video metadata, or to the last annotated frame + 1.
+    The bins are binWidth frames wide, the last one can be shorter.
+    '''
+    logger.debug(f"Get: /api/annotationsummary?videoId={videoId}&bins={bins}&type={type}&labels={labels}&frameCount={frameCount}")
+    try:
+        if bins < 1 or bins > 10000:
+            raise HTTPException(status_code=400, detail='bins should be between 1 and 10000')
+        match = {"videoId": videoId}
+        if type is not None:
+            match['type'] = type
+        if labels is not None:
+            match['label'] = {"$in": labels.split('@@')}
+        if frameCount is None:
+            frameCount = await summary_frame_count(videoId)
+        if frameCount < 1:
+            raise HTTPException(status_code=400, detail='frameCount should be positive')
+        binWidth = -(-frameCount // bins)
+        bin_count = -(-frameCount // binWidth)
+
+        # one document per label, so that no output document grows with the number of labels
+        pipeline = [
+            {"$match": match},
+            {"$group": {"_id": {"label": "$label", "frameNum": "$frameNum"}, "count": {"$sum": 1}}},
+            {"$group": {"_id": {"label": "$_id.label", "bin": {"$floor": {"$divide": ["$_id.frameNum", binWidth]}}},
+                        "count": {"$sum": "$count"}, "frames": {"$sum": 1},
+                        "first": {"$min": "$_id.frameNum"}, "last": {"$max": "$_id.frameNum"}}},
+            {"$group": {"_id": "$_id.label", "count": {"$sum": "$count"}, "frames": {"$sum": "$frames"},
+                        "first": {"$min": "$first"}, "last": {"$max": "$last"},
+                        "bins": {"$push": {"bin": "$_id.bin", "frames": "$frames"}}}},
+        ]
+        await app.annotation_writes.flush()
+        summary = {}
+        async for entry in app.mongodb.annotation.aggregate(pipeline, allowDiskUse=True):
+            occupancy = [0] * bin_count
+            for b in entry['bins']:
+                bin = int(b['bin'])
+                if 0 <= bin < bin_count:
+                    occupancy[bin] = b['frames'] / min(binWidth, frameCount - bin * binWidth)
+            summary[entry['_id']] = {'count': entry['count'], 'frames': entry['frames'], 'coverage': entry['frames'] / frameCount,
+                                     'first': entry['first'], 'last': entry['last'], 'occupancy': occupancy}
+        return {'videoId': videoId, 'frameCount': frameCount, 'binWidth': binWidth, 'labels': summary}
+    except Exception as e:
+        print('error')
+        return error_handler(e)
+
+
+async def summary_frame_count(videoId):
+    res = await app.mongodb.video.find_one({"_id": videoId}, {"_id": 0, "meta.frame_count": 1})
+    if res is not None and res.get('meta') is not None and res['meta'].get('frame_count'):
+        return int(res['meta']['frame_count'])
+    last = await app.mongodb.annotation.find({"videoId": videoId}, {"_id": 0, "frameNum": 1}) \
+        .sort([("frameNum", -1)]) \
+        .limit(1) \
+        .to_list(None)
+    return last[0]['frameNum'] + 1 if len(last) > 0 else 0
+
+async def get_chart_timeline(videoId, frameNum, labels, range):
+    start = end = None
+    if frameNum is not None and range is not None:
+        start, end = max(frameNum - range, 0), frameNum + range
+    timeline = await get_timeline(videoId)
+    names = timeline.keys() if labels is None else labels.split('@@')
+    return {'videoId': videoId, 'start': start, 'end': end,
+            'labels': {name: clip_runs(timeline.get(name, no_runs()), start, end).tolist() for name in names}}
+
 
-additionalDataReaders = {}
 
 @app.get('/api/additionaldata/{videoId}')
-async def getAdditionalDataHandler(videoId: ObjectId, names: str):
-    logger.debug(f'api/additionaldata/{videoId}?names={names}')
+async def getAdditionalDataHandler(videoId: ObjectId, names: str, start: int = 0, end: int = None, step: int = 1,
+                                   format: str = 'json'):
+    '''
+    The data of frames start, start+step, ... up to end (inclusive, default the last frame) of each additional field in names (separated by @@).
+    With format=binary, the data is sent as typed arrays, see additional_data_payload.
+    '''
+    logger.debug(f'api/additionaldata/{videoId}?names={names}&start={start}&end={end}&step={step}&format={format}')
     try:
         namesToRetrieve = names.split('@@')
         if len(namesToRetrieve)==0:
             raise HTTPException(status_code=400, detail='No additional data name in the request')
+        if start < 0 or (end is not None and end < start) or step < 1:
+            raise HTTPException(status_code=416, detail='Invalid frame range')
+        if format not in ('json', 'binary'):
+            raise HTTPException(status_code=400, detail='format should be json or binary')
 
         fieldsInfo = await app.mongodb.video.find_one({"_id": ObjectId(videoId)}, { "_id": 0, "additionalFields": 1 })
         if fieldsInfo is None:
@@ -518,16 +1261,108 @@ async def getAdditionalDataHandler(videoId: ObjectId, names: str):
             return {'error': 'The number of addtional data found in DB does not match the number of request data names',
                     'inDB': fieldList,
                     'toRetrieve': namesToRetrieve}
-        data = {}
-        for field in fieldList:
-            res = getAdditionalData(field['name'], field['path'])
-            data[field['name']] = res
-        return data
+        results = await asyncio.gather(*(load_additional_data(field['name'], field['path']) for field in fieldList))
+        window = slice(start, None if end is None else end + 1, step)
+        data = {field['name']: None if res is None else res[window] for field, res in zip(fieldList, results)}
+        if format == 'binary':
+            try:
+                payload = await asyncio.get_running_loop().run_in_executor(None, additional_data_payload, data, start, step)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            return Response(content=payload, media_type='application/octet-stream')
+        return Response(content=await asyncio.get_running_loop().run_in_executor(None, dumps_additional_data, data),
+                        media_type='application/json')
     except Exception as e:
         print('error')
         return error_handler(e)
 
 
+def dumps_additional_data(data):
+    return orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY, default=lambda value: value.tolist())
+
+
+def additional_data_payload(data, start, step):
+    '''
+    Pack the arrays of data as:
+        uint32 little endian: length of the header
+        header: JSON {"start": start, "step": step, "arrays": {name: {"dtype": "<f4", "shape": [...], "offset": byte offset}}}
+        the little endian, C ordered bytes of each array, at its offset from the start of the payload, aligned to 8 bytes
+    so that a browser can view each array as a typed array without copying it.
+    '''
+    arrays = {}
+    for name, values in data.items():
+        try:
+            array = np.asarray(values)
+        except ValueError:
+            raise ValueError(f'{name} is not a regular array and cannot be sent as binary')
+        if array.dtype.kind not in 'biuf':
+            raise ValueError(f'{name} is not an array of numbers and cannot be sent as binary')
+        arrays[name] = np.ascontiguousarray(array, dtype=array.dtype.newbyteorder('<'))
+
+    def layout(first_offset):
+        offsets = {}
+        offset = first_offset
+        for name, array in arrays.items():
+            offsets[name] = offset
+            offset += -(-array.nbytes // 8) * 8
+        header = orjson.dumps({'start': start, 'step': step,
+                               'arrays': {name: {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offsets[name]}
+                                          for name, array in arrays.items()}})
+        return header, offsets
+
+    # the offsets depend on the length of the header, move them until the header fits before them
+    first_offset = 8
+    header, offsets = layout(first_offset)
+    while 4 + len(header) > first_offset:
+        first_offset = -(-(4 + len(header)) // 8) * 8
+        header, offsets = layout(first_offset)
+    payload = bytearray(len(header).to_bytes(4, 'little') + header)
+    for name, array in arrays.items():
+        payload += bytes(offsets[name] - len(payload))
+        payload += array.tobytes()
+    return bytes(payload)
+
+
+async def load_additional_data(name, path):
+    '''
+    Return getAdditionalData(name, path), read on the executor and cached until the file is modified.
+    Concurrent requests for the same data wait for the same read.
+    '''
+    try:
+        mtime = os.stat(path).st_mtime if path is not None else None
+    except OSError:
+        mtime = None
+    key = (name, path, mtime)
+    data = app.additional_data.get(key)
+    if data is not None:
+        return data
+    load = app.additional_data_loads.get(key)
+    if load is None:
+        load = asyncio.get_running_loop().run_in_executor(None, read_additional_data, name, path)
+        app.additional_data_loads[key] = load
+        load.add_done_callback(lambda done: cache_additional_data(key, done))
+    # a client going away must not cancel the read for the others
+    data, _ = await asyncio.shield(load)
+    return data
+
+
+def read_additional_data(name, path):
+    ''' Return the data and its size, measured on the executor as it can take seconds for large data. '''
+    data = getAdditionalData(name, path)
+    return data, deep_sizeof(data)
+
+
+def cache_additional_data(key, load):
+    app.additional_data_loads.pop(key, None)
+    name, path, mtime = key
+    if mtime is None or load.cancelled() or load.exception() is not None:
+        return
+    # data read from older versions of the file is stale
+    app.additional_data.invalidate(lambda k: k[1] == path and k[2] != mtime)
+    data, size = load.result()
+    app.additional_data.put(key, data, size)
+
+
 
 
 @app.exception_handler(HTTPException)
@@ -543,7 +1378,7 @@ def error_handler(e):
         raise e
     return JSONResponse(
         status_code=500,
-        content={"error": ', '.join(list(e.args))}
+        content={"error": ', '.join(str(arg) for arg in e.args)}
     )
 
 
@@ -577,36 +1412,30 @@ async def post_one_obj_mongo(obj, type):
         return {'info': f'{type} already exists'}
 
 
-lock_annotation_tag = None
+category_locks = {}
 
 async def post_one_category_annotation_mongo(obj):
     collection = app.mongodb.annotation
-    global lock_annotation_tag
-    if lock_annotation_tag is None:
-        lock_annotation_tag = {"createdAt": datetime.now()}
-
-        existing_label = await collection.find_one({"videoId": ObjectId(obj.videoId), "type": 'category', "frameNum": obj.frameNum, "label": obj.label})
-        if existing_label is None:
-            new_obj = await collection.insert_one(obj.model_dump(by_alias=True))
-            res = new_obj
-        else:
-            res = 'category annotation already exists'
-        lock_annotation_tag = None
-        return res
-    elif (datetime.now() - lock_annotation_tag['createdAt']).total_seconds() > 3:
-        lock_annotation_tag = {"createdAt": datetime.now()}
-
-        existing_label = await collection.find_one({"videoId": ObjectId(obj.videoId), "type": 'category', "frameNum": obj.frameNum, "label": obj.label})
-        if existing_label is None:
-            new_obj = await collection.insert_one(obj.model_dump(by_alias=True))
-            res = new_obj
-        else:
-            res = 'category annotation already exists'
-        lock_annotation_tag = None
-        return res
-    else:
-        await asyncio.sleep(0.1)
-        return await post_one_category_annotation_mongo(obj)
+    if app.category_index:
+        try:
+            return await collection.insert_one(obj.model_dump(by_alias=True))
+        except DuplicateKeyError:
+            return 'category annotation already exists'
+
+    # without the unique index, serialize inserts of the same label on the same frame
+    key = (obj.videoId, obj.frameNum, obj.label)
+    entry = category_locks.setdefault(key, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            existing_label = await collection.find_one({"videoId": ObjectId(obj.videoId), "type": 'category', "frameNum": obj.frameNum, "label": obj.label})
+            if existing_label is None:
+                return await collection.insert_one(obj.model_dump(by_alias=True))
+            return 'category annotation already exists'
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            del category_locks[key]
 
 
 async def edit_one_obj_mongo(obj, type):
@@ -661,65 +1490,315 @@ async def delete_multiple_obj_mongo(type, ids):
     delete_result = await collection.delete_many({"_id": {"$in": ids}})
     return delete_result
 
-async def delete_video_annotation_mongo(videoId):
-    collection = app.mongodb.annotation
-    delete_result = await collection.delete_many({"videoId": ObjectId(videoId)})
-    return delete_result
-
-async def post_video_annotations_mongo(annotations):
+async def save_annotations(docs, videoIds):
     '''
-    This func should be called after deleting exsiting objs for the video in db,
-    thus does not check if each obj exists before insertion
+    Save the annotation docs of the videos with save_annotations_mongo, in a transaction if possible,
+    and apply the changes of category annotations to the timelines of the videos.
+    Timelines are marked dirty during the save, so that they are rebuilt if it fails half way.
     '''
-    if len(annotations) == 0:
-        return {'success': f'Added 0 {type}'}
+    # buffered edits written after the save would overwrite it
+    await app.annotation_writes.flush()
+    async with lock_timelines(videoIds):
+        timelines = await load_timelines(videoIds)
+        if len(timelines) > 0:
+            await app.mongodb.timeline.update_many({"_id": {"$in": list(timelines)}}, {"$set": {"dirty": True}})
+        changes = {}
+        res = await run_transaction(lambda session: save_annotations_mongo(docs, videoIds, session, changes))
+        # without the unique index, a removed category may be duplicated on its frame, rebuild instead
+        if app.category_index:
+            await update_timelines(timelines, changes['added'], changes['removed'])
+    return res
+
+
+timeline_locks = {}
+
+@asynccontextmanager
+async def lock_timelines(videoIds):
+    ''' Serialize the changes to the timelines of the videos, locking them in a fixed order. '''
+    keys = sorted(set(videoIds))
+    entries = [timeline_locks.setdefault(key, [asyncio.Lock(), 0]) for key in keys]
+    for entry in entries:
+        entry[1] += 1
+    try:
+        async with AsyncExitStack() as stack:
+            for entry in entries:
+                await stack.enter_async_context(entry[0])
+            yield
+    finally:
+        for key, entry in zip(keys, entries):
+            entry[1] -= 1
+            if entry[1] == 0:
+                del timeline_locks[key]
+
 
+async def load_timelines(videoIds):
+    ''' Return {videoId: {label: runs}} of the videos whose timeline is built and up to date. '''
+    timelines = {}
+    async for doc in app.mongodb.timeline.find({"_id": {"$in": list(videoIds)}, "dirty": False}):
+        timelines[doc['_id']] = {entry['label']: decode_runs(entry['runs']) for entry in doc['labels']}
+    return timelines
+
+
+async def store_timeline(videoId, labels):
+    await app.mongodb.timeline.replace_one(
+        {"_id": videoId},
+        {"dirty": False, "labels": [{"label": label, "runs": encode_runs(runs)} for label, runs in labels.items() if len(runs) > 0]},
+        upsert=True)
+
+
+async def update_timelines(timelines, added, removed):
+    '''
+    Apply the added and removed category annotations to the timelines, {videoId: {label: runs}}, and store them.
+    '''
+    frames = {}
+    for docs, kind in ((removed, 0), (added, 1)):
+        for doc in docs:
+            frames.setdefault(doc['videoId'], {}).setdefault(doc['label'], ([], []))[kind].append(doc['frameNum'])
+    for videoId, labels in timelines.items():
+        for label, (removed_frames, added_frames) in frames.get(videoId, {}).items():
+            runs = labels.get(label, no_runs())
+            labels[label] = add_frames(remove_frames(runs, removed_frames), added_frames)
+        await store_timeline(videoId, labels)
+
+
+async def write_annotations_mongo(ops):
+    '''
+    Write the buffered single annotation edits, ops being {id: annotation doc to upsert, or None to delete}.
+    Deletes run first, so that a category label moved to another annotation does not hit the unique index.
+    Return {id: HTTPException} for the edits that failed.
+    '''
     collection = app.mongodb.annotation
-    res = await collection.insert_many([anno.model_dump(by_alias=True) for anno in annotations])
-    check = await collection.find({"videoId": ObjectId(annotations[0].videoId)}).to_list(None)
-    return len(check)
+    ids = list(ops)
+    docs = {id: doc for id, doc in ops.items() if doc is not None}
+    if setting('packed_annotations', False):
+        docs = dict(zip(docs, await pack_annotations(list(docs.values()))))
+    stored = await collection.find({"_id": {"$in": ids}}, {"videoId": 1}).to_list(None)
+    videoIds = {doc['videoId'] for doc in stored} | {doc['videoId'] for doc in docs.values()}
+    errors = {}
+    async with lock_timelines(videoIds):
+        timelines = await load_timelines(videoIds)
+        if len(timelines) > 0:
+            await app.mongodb.timeline.update_many({"_id": {"$in": list(timelines)}}, {"$set": {"dirty": True}})
+        old_docs = {doc['_id']: doc async for doc in collection.find({"_id": {"$in": ids}, "type": "category"})}
+        deleted = [id for id, doc in ops.items() if doc is None]
+        if len(deleted) > 0:
+            await collection.delete_many({"_id": {"$in": deleted}})
+        upserts = list(docs.items())
+        if len(upserts) > 0:
+            try:
+                await collection.bulk_write([ReplaceOne({"_id": id}, doc, upsert=True) for id, doc in upserts], ordered=False)
+            except BulkWriteError as e:
+                for error in e.details['writeErrors']:
+                    id, doc = upserts[error['index']]
+                    if error['code'] == 11000:
+                        errors[id] = HTTPException(status_code=409, detail=f'{doc["label"]} already exists on frame {doc["frameNum"]}')
+                    else:
+                        errors[id] = HTTPException(status_code=500, detail=error['errmsg'])
+        if app.category_index:
+            added = [doc for id, doc in docs.items() if id not in errors and doc['type'] == 'category']
+            removed = [doc for id, doc in old_docs.items() if id not in errors]
+            await update_timelines(timelines, added, removed)
+    return errors
+
+
+async def get_timeline(videoId):
+    '''
+    Return the timeline of the video, {label: runs}, building it from its category annotations if needed.
+    '''
+    timelines = await load_timelines([videoId])
+    if videoId in timelines:
+        return timelines[videoId]
+    async with lock_timelines([videoId]):
+        timelines = await load_timelines([videoId])
+        if videoId in timelines:
+            return timelines[videoId]
+        frames = {}
+        async for doc in app.mongodb.annotation.find({"videoId": videoId, "type": "category"}, {"_id": 0, "label": 1, "frameNum": 1}):
+            frames.setdefault(doc['label'], []).append(doc['frameNum'])
+        labels = {label: runs_from_frames(f) for label, f in frames.items()}
+        await store_timeline(videoId, labels)
+        logger.debug(f'Built timeline of video {videoId}: {len(labels)} labels')
+        return labels
+
+
+async def run_transaction(fn):
+    '''
+    Run fn(session) in a transaction if the database supports them, retrying it on transient errors.
+    Otherwise fn(None) runs on its own, so the save functions write before they delete
+    and can be retried, and readers never see an empty project.
+    '''
+    if not app.transactions:
+        return await fn(None)
+    async with await app.mongodb.client.start_session() as session:
+        return await session.with_transaction(fn)
 
-async def delete_project_objs_mongo(projectId, type, videoIds=None):
+
+async def save_project_objs_mongo(objs, type, projectId, session=None):
+    '''
+    Make the objs of the project match objs: upsert every obj, then delete the ones not in objs.
+    Fields set by the server, like the video meta, are kept.
+
+    type: 'video', 'btn'
+    return: (number of saved objs, number of deleted objs)
+    '''
     if type=='video':
         collection = app.mongodb.video
     elif type=='btn':
         collection = app.mongodb.btn
-    elif type=='annotation':
-        collection = app.mongodb.annotation
 
-    if type != 'annotation':
-        delete_result = await collection.delete_many({"projectId": ObjectId(projectId)})
-    else:
-        videoIds = [ObjectId(vid) for vid in videoIds]
-        delete_result = await collection.delete_many({"videoId": {"$in": videoIds}})
-    return delete_result
+    ids = []
+    requests = []
+    for obj in objs:
+        doc = obj.model_dump(by_alias=True)
+        id = doc.pop('_id')
+        ids.append(id)
+        requests.append(UpdateOne({"_id": id}, {"$set": doc}, upsert=True))
+    saved = 0
+    if len(requests) > 0:
+        res = await collection.bulk_write(requests, ordered=False, session=session)
+        saved = res.matched_count + res.upserted_count
+    delete_res = await collection.delete_many({"projectId": ObjectId(projectId), "_id": {"$nin": ids}}, session=session)
+    return saved, delete_res.deleted_count
+
+
+async def find_btn_groups(docs):
+    '''
+    Return {groupIndex: btn group document} for the btn groups of docs.
+    '''
+    ids = {doc.get('groupIndex') for doc in docs} - {None}
+    if len(ids) == 0:
+        return {}
+    return {group['_id']: group async for group in app.mongodb.btn.find({"_id": {"$in": list(ids)}}, {"childData": 1})}
 
 
-async def post_project_objs_mongo(objs, type, videoIds=None):
+async def pack_annotations(docs):
     '''
-    This func should be called after deleting exsiting objs for the project in db,
-    thus does not check if each obj exists before insertion
-
-    type: 'video', 'btn', 'annotation'
+    Return the annotation docs packed, storing the schemas of the packed skeletons first,
+    so that the annotations never refer to a missing schema.
+    '''
+    groups = await find_btn_groups([doc for doc in docs if doc['type'] == 'skeleton'])
+    schemas = {}
+    docs = [pack(doc, groups.get(doc.get('groupIndex')), schemas) for doc in docs]
+    new_schemas = {id: names for id, names in schemas.items() if id not in app.packed_schemas}
+    if len(new_schemas) > 0:
+        # a schema id is a hash of its names, so existing ones are left as they are
+        await app.mongodb.packed_schema.bulk_write(
+            [UpdateOne({"_id": id}, {"$setOnInsert": {"names": names}}, upsert=True) for id, names in new_schemas.items()],
+            ordered=False)
+        app.packed_schemas.update(new_schemas)
+    return docs
+
+
+async def expand_annotations(docs):
+    '''
+    Expand the packed data of the annotation documents read from the db, in place.
+    Schemas never change once stored, so they are kept in app.packed_schemas once read.
+    '''
+    ids = {doc['packed']['schema'] for doc in docs if 'schema' in doc.get('packed', {})} - app.packed_schemas.keys()
+    if len(ids) > 0:
+        async for schema in app.mongodb.packed_schema.find({"_id": {"$in": list(ids)}}):
+            app.packed_schemas[schema['_id']] = schema['names']
+    return unpack_many(docs, app.packed_schemas)
+
+
+def category_key(doc):
+    return (doc['videoId'], doc['frameNum'], doc['label'])
+
+
+def check_category_duplicates(docs):
+    ''' Raise a 409 if the docs set a category label twice on a frame, which the unique category index rejects. '''
+    seen = set()
+    duplicates = []
+    for doc in docs:
+        if doc['type'] != 'category':
+            continue
+        key = category_key(doc)
+        if key in seen:
+            duplicates.append(doc)
+        seen.add(key)
+    if len(duplicates) > 0:
+        raise HTTPException(status_code=409, detail='Category labels set more than once: ' + ', '.join(
+            f'{doc["label"]} on frame {doc["frameNum"]} of video {doc["videoId"]}' for doc in duplicates[:10]))
+
+
+async def save_annotations_mongo(docs, videoIds, session=None, changes=None):
     '''
-    if len(objs) == 0:
-        return {'success': f'Added 0 {type}'}
+    Make the annotations stored for the videos match the annotation docs,
+    writing only the added, changed and removed ones in one unordered bulk write.
+    Deletes run after the upserts in an unordered bulk write, so the videos are never left empty.
+    changes, if given, receives the category annotations written ('added') and overwritten or deleted ('removed').
+    '''
+    collection = app.mongodb.annotation
+    if app.category_index:
+        check_category_duplicates(docs)
+    if setting('packed_annotations', False):
+        docs = await pack_annotations(docs)
+    new_docs = {doc['_id']: doc for doc in docs}
+
+    requests = []
+    written_docs = []
+    overwritten_docs = []
+    removed = {}
+    unchanged = 0
+    updated = 0
+    async for doc in collection.find({"videoId": {"$in": [ObjectId(vid) for vid in videoIds]}}, session=session):
+        new_doc = new_docs.pop(doc['_id'], None)
+        if new_doc is None:
+            removed[doc['_id']] = doc
+        elif new_doc == doc:
+            unchanged += 1
+        else:
+            requests.append(ReplaceOne({"_id": doc['_id']}, new_doc))
+            written_docs.append(new_doc)
+            overwritten_docs.append(doc)
+            updated += 1
+    # what is left is new to these videos
+    requests.extend(ReplaceOne({"_id": id}, doc, upsert=True) for id, doc in new_docs.items())
+    written_docs.extend(new_docs.values())
+
+    # removed category labels re-added under a new id would hit the unique category index, delete those first
+    written_categories = {category_key(doc) for doc in written_docs if doc['type'] == 'category'}
+    replaced = [id for id, doc in removed.items() if doc['type'] == 'category' and category_key(doc) in written_categories]
+    # one DeleteOne per id, as an $in of all the removed ids can exceed the 16MB BSON limit; pymongo batches them
+    if len(replaced) > 0:
+        await collection.bulk_write([DeleteOne({"_id": id}) for id in replaced], ordered=False, session=session)
+    replaced_ids = set(replaced)
+    requests.extend(DeleteOne({"_id": id}) for id in removed if id not in replaced_ids)
+    if len(requests) > 0:
+        try:
+            await collection.bulk_write(requests, ordered=False, session=session)
+        except BulkWriteError as e:
+            # e.g. a category label set on the frame by a write to another video of the same id
+            conflicts = [written_docs[error['index']] for error in e.details['writeErrors']
+                         if error['code'] == 11000 and error['index'] < len(written_docs)]
+            if len(conflicts) == 0:
+                raise
+            raise HTTPException(status_code=409, detail='Category labels already set: ' + ', '.join(
+                f'{doc["label"]} on frame {doc["frameNum"]}' for doc in conflicts[:10]))
+    if changes is not None:
+        changes['added'] = [doc for doc in written_docs if doc['type'] == 'category']
+        changes['removed'] = [doc for doc in overwritten_docs + list(removed.values()) if doc['type'] == 'category']
+    return {'success': f'added {len(new_docs)}, updated {updated}, deleted {len(removed)} annotations, {unchanged} unchanged',
+            'added': len(new_docs),
+            'updated': updated,
+            'deleted': len(removed),
+            'unchanged': unchanged}
 
-    if type=='project':
-        collection = app.mongodb.project
-    elif type=='video':
+
+async def delete_project_objs_mongo(projectId, type, videoIds=None):
+    if type=='video':
         collection = app.mongodb.video
     elif type=='btn':
         collection = app.mongodb.btn
     elif type=='annotation':
         collection = app.mongodb.annotation
 
-    res = await collection.insert_many([obj.model_dump(by_alias=True) for obj in objs])
     if type != 'annotation':
-        check = await collection.find({"projectId": objs[0].projectId}).to_list(None)
+        delete_result = await collection.delete_many({"projectId": ObjectId(projectId)})
     else:
-        check = await collection.find({"videoId": {"$in": videoIds}}).to_list(None)
-    return len(check)
-
-
-
+        videoIds = [ObjectId(vid) for vid in videoIds]
+        await app.annotation_writes.flush()
+        async with lock_timelines(videoIds):
+            delete_result = await collection.delete_many({"videoId": {"$in": videoIds}})
+            await app.mongodb.timeline.delete_many({"_id": {"$in": videoIds}})
+    return delete_result
@@ -0,0 +1,92 @@
+'''
+Packed storage of the data of skeleton and polygon annotations.
+
+A packed annotation stores data as the bytes of a float32 array, and describes it in packed:
+    shape   [rows, columns] of the array
+    fields  skeleton only, the field of each column, e.g. ['x', 'y', 'visibility']
+    schema  skeleton only, the id of the point names of the rows, stored once in the packed_schema collection
+            as {_id: schema, names: [...]}. The id is a hash of the names, so a schema never changes once stored,
+            whatever happens to the btn group later. Points missing from the annotation are rows of NaN.
+Polygon rows are the points of the polygon.
+'''
+import hashlib
+import numpy as np
+import orjson
+
+
+def _string(value):
+    return str(getattr(value, 'value', value))
+
+
+def schema_id(names):
+    return hashlib.sha1(orjson.dumps(names)).hexdigest()
+
+
+def _point_names(data, group):
+    '''
+    The names of the rows: the labels or indexes of the buttons (childData) of the btn group, in their order,
+    if they cover the points of data, so that the annotations of a group share one schema, otherwise the points of data.
+    '''
+    if group is not None:
+        for keys in ('label', 'index'):
+            names = [str(btn[keys]) for btn in group.get('childData', [])]
+            if set(data) <= set(names):
+                return names
+    return list(data)
+
+
+def pack(doc, group, schemas):
+    '''
+    Return a copy of the annotation document with its data packed, or doc itself if its data cannot be packed.
+    group is the btn group document of the annotation, if any.
+    The schemas of packed skeletons are added to schemas, {schema id: names}, to be stored before the doc.
+    '''
+    data = doc.get('data')
+    type = _string(doc.get('type'))
+    if type == 'polygon' and isinstance(data, list) and len(data) > 0 \
+            and all(isinstance(p, list) and len(p) == len(data[0]) for p in data):
+        array = np.array(data, dtype=np.float32)
+        packed = {'shape': list(array.shape)}
+    elif type == 'skeleton' and isinstance(data, dict) and len(data) > 0 \
+            and all(isinstance(p, dict) for p in data.values()):
+        fields = list(next(iter(data.values())))
+        if any(set(p) != set(fields) for p in data.values()):
+            return doc
+        names = _point_names(data, group)
+        array = np.full((len(names), len(fields)), np.nan, dtype=np.float32)
+        for row, name in enumerate(names):
+            point = data.get(name)
+            if point is not None:
+                array[row] = [point[f] for f in fields]
+        schema = schema_id(names)
+        schemas[schema] = names
+        packed = {'shape': list(array.shape), 'fields': fields, 'schema': schema}
+    else:
+        return doc
+    # plain bytes, as pymongo decodes stored binary, so that the stored and the new doc compare equal
+    return {**doc, 'data': array.tobytes(), 'packed': packed}
+
+
+def unpack_many(docs, schemas):
+    '''
+    Expand in place the packed data of the annotation documents.
+    schemas maps the schema ids of the packed skeletons to their point names.
+    The float32 values of all docs are converted to their shortest decimal at once, as they were sent by the client.
+    '''
+    packed_docs = [doc for doc in docs if 'packed' in doc]
+    if len(packed_docs) == 0:
+        return docs
+    arrays = [np.frombuffer(doc['data'], dtype=np.float32) for doc in packed_docs]
+    values = np.concatenate(arrays).astype(str).astype(np.float64)
+    start = 0
+    for doc, array in zip(packed_docs, arrays):
+        packed = doc.pop('packed')
+        rows = values[start:start+len(array)].reshape(packed['shape'])
+        start += len(array)
+        if 'fields' not in packed:
+            doc['data'] = rows.tolist()
+            continue
+        names = schemas[packed['schema']]
+        doc['data'] = {name: dict(zip(packed['fields'], row))
+                       for name, row in zip(names, rows.tolist()) if not np.isnan(row[0])}
+    return docs
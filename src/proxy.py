@@ -0,0 +1,149 @@
+import asyncio
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+import cv2 as cv
+from decoder import resize
+
+logger = logging.getLogger('video_annotation')
+
+
+def source_of(path):
+    ''' The path, size and mtime of the video file, recorded with its proxy to tell when the proxy is stale. '''
+    stat = os.stat(path)
+    return {'path': path, 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def build_proxy(path, proxy_path, width, report):
+    '''
+    Write a copy of the video downscaled to width as Motion JPEG, so that every frame is a key frame,
+    and the source of the proxy next to it, in proxy_path.json. Return the source.
+    report(framesDone, frameCount) is called every 100 frames.
+    '''
+    # taken before reading, so that a file changed during the build leaves the proxy stale
+    source = source_of(path)
+    cap = cv.VideoCapture(path)
+    writer = None
+    tmp_path = proxy_path + '.tmp.avi'
+    try:
+        if not cap.isOpened():
+            raise Exception(f'Cannot open {path}')
+        frame_count = int(cap.get(cv.CAP_PROP_FRAME_COUNT))
+        fps = cap.get(cv.CAP_PROP_FPS) or 30
+        num = 0
+        while True:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            frame = resize(frame, width)
+            if writer is None:
+                h, w = frame.shape[:2]
+                writer = cv.VideoWriter(tmp_path, cv.VideoWriter_fourcc(*'MJPG'), fps, (w, h))
+            writer.write(frame)
+            num += 1
+            if num % 100 == 0:
+                report(num, frame_count)
+        if writer is None:
+            raise Exception(f'No frame decoded from {path}')
+        writer.release()
+        writer = None
+        # the proxy is used only once its own source is written
+        if os.path.exists(proxy_path + '.json'):
+            os.remove(proxy_path + '.json')
+        os.replace(tmp_path, proxy_path)
+        with open(proxy_path + '.json', 'w') as f:
+            json.dump(source, f)
+        report(num, num)
+        return source
+    finally:
+        cap.release()
+        if writer is not None:
+            writer.release()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class ProxyBuilder:
+    '''
+    Background queue building low-resolution proxies of videos into proxy_dir.
+    status holds the state of each queued video: queued, building, done or failed, and the fraction of frames done.
+    '''
+    def __init__(self, proxy_dir, width=320, workers=1):
+        self.proxy_dir = proxy_dir
+        self.width = width
+        self.workers = workers
+        self.queue = asyncio.Queue()
+        self.status = {}
+        # videoId: source of its built proxy
+        self.sources = {}
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='proxy')
+        self.tasks = []
+
+    def start(self):
+        os.makedirs(self.proxy_dir, exist_ok=True)
+        self.tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    def proxy_path(self, videoId):
+        return os.path.join(self.proxy_dir, f'{videoId}_{self.width}.avi')
+
+    def ready(self, videoId, path):
+        '''
+        Return the proxy path of the video if it is built from the video file as it is now,
+        the same path, size and mtime, rather than from a file the video was registered with before.
+        '''
+        proxy_path = self.proxy_path(videoId)
+        try:
+            source = self.sources.get(videoId)
+            if source is None:
+                with open(proxy_path + '.json') as f:
+                    source = self.sources[videoId] = json.load(f)
+            if source == source_of(path) and os.path.exists(proxy_path):
+                return proxy_path
+        except (OSError, ValueError):
+            pass
+        return None
+
+    def submit(self, videoId, path):
+        state = self.get_status(videoId, path)
+        if state['status'] in ('queued', 'building', 'done'):
+            return state
+        self.status[videoId] = {'status': 'queued', 'progress': 0}
+        self.queue.put_nowait((videoId, path))
+        return self.status[videoId]
+
+    def get_status(self, videoId, path):
+        state = self.status.get(videoId)
+        if state is not None and state['status'] != 'done':
+            return state
+        if self.ready(videoId, path):
+            return {'status': 'done', 'progress': 1}
+        return {'status': 'none', 'progress': 0}
+
+    async def _work(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            videoId, path = await self.queue.get()
+            state = self.status[videoId]
+            state['status'] = 'building'
+
+            def report(done, total):
+                state['progress'] = done / total if total > 0 else 0
+
+            try:
+                self.sources.pop(videoId, None)
+                source = await loop.run_in_executor(self.executor, build_proxy, path, self.proxy_path(videoId), self.width, report)
+                self.sources[videoId] = source
+                state['status'] = 'done'
+                logger.debug(f'Built proxy of {path}')
+            except Exception as e:
+                state['status'] = 'failed'
+                state['error'] = str(e)
+                logger.error(f'Building proxy of {path} failed: {e}')
+            finally:
+                self.queue.task_done()
+
+    def close(self):
+        for task in self.tasks:
+            task.cancel()
+        self.executor.shutdown(wait=False, cancel_futures=True)
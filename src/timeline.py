@@ -0,0 +1,76 @@
+'''
+Run-length encoded timelines of category labels: for each label, the sorted, disjoint, non-adjacent
+runs [start, end] (inclusive) of frames the label is set on, as int32 arrays of shape (n, 2).
+'''
+import numpy as np
+from bson import Binary
+
+
+def no_runs():
+    return np.zeros((0, 2), dtype=np.int32)
+
+
+def runs_from_frames(frames):
+    frames = np.unique(np.asarray(frames, dtype=np.int32))
+    if len(frames) == 0:
+        return no_runs()
+    breaks = np.flatnonzero(np.diff(frames) > 1)
+    starts = np.concatenate(([frames[0]], frames[breaks + 1]))
+    ends = np.concatenate((frames[breaks], [frames[-1]]))
+    return np.stack((starts, ends), axis=1).astype(np.int32)
+
+
+def add_frames(runs, frames):
+    ''' The runs with frames set. '''
+    new_runs = np.concatenate((runs, runs_from_frames(frames)))
+    if len(new_runs) == 0:
+        return no_runs()
+    new_runs = new_runs[np.argsort(new_runs[:, 0], kind='stable')]
+    # a run starts a merged run unless it touches a previous one
+    reach = np.maximum.accumulate(new_runs[:, 1])
+    first = np.concatenate(([True], new_runs[1:, 0] > reach[:-1] + 1))
+    starts = new_runs[first, 0]
+    ends = reach[np.concatenate((np.flatnonzero(first)[1:] - 1, [len(new_runs) - 1]))]
+    return np.stack((starts, ends), axis=1).astype(np.int32)
+
+
+def remove_frames(runs, frames):
+    ''' The runs with frames cleared. '''
+    cuts = runs_from_frames(frames)
+    if len(cuts) == 0 or len(runs) == 0:
+        return runs
+    result = []
+    c = 0
+    for start, end in runs.tolist():
+        while c < len(cuts) and cuts[c, 1] < start:
+            c += 1
+        k = c
+        while k < len(cuts) and cuts[k, 0] <= end:
+            if cuts[k, 0] > start:
+                result.append((start, int(cuts[k, 0]) - 1))
+            start = int(cuts[k, 1]) + 1
+            k += 1
+        if start <= end:
+            result.append((start, end))
+    return np.array(result, dtype=np.int32).reshape(-1, 2)
+
+
+def clip_runs(runs, start=None, end=None):
+    ''' The runs overlapping frames start to end, clipped to them. '''
+    lo = 0 if start is None else np.searchsorted(runs[:, 1], start, side='left')
+    hi = len(runs) if end is None else np.searchsorted(runs[:, 0], end, side='right')
+    clipped = runs[lo:hi].copy()
+    if len(clipped) > 0:
+        if start is not None:
+            clipped[0, 0] = max(clipped[0, 0], start)
+        if end is not None:
+            clipped[-1, 1] = min(clipped[-1, 1], end)
+    return clipped
+
+
+def encode_runs(runs):
+    return Binary(np.ascontiguousarray(runs, dtype='<i4').tobytes())
+
+
+def decode_runs(data):
+    return np.frombuffer(data, dtype='<i4').reshape(-1, 2)
@@ -0,0 +1,87 @@
+import asyncio
+import logging
+
+logger = logging.getLogger('video_annotation')
+
+
+class WriteBehindBuffer:
+    '''
+    Writes queued by key and written together by write(ops), ops being {key: op},
+    interval seconds after the first queued one, or as soon as max_ops keys are pending.
+    A write queued for a key that is still pending replaces the previous one, so only the last is written.
+    write returns {key: result} for the keys that need one, e.g. errors. Writes run one at a time, in the order they are flushed.
+    '''
+    def __init__(self, write, interval=0.1, max_ops=500):
+        self.write = write
+        self.interval = interval
+        self.max_ops = max_ops
+        # key: [op, futures of the requests waiting for it]
+        self.pending = {}
+        self.queued = asyncio.Event()
+        self.full = asyncio.Event()
+        self.lock = asyncio.Lock()
+        self.task = None
+        self.coalesced = 0
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    def submit(self, key, op):
+        '''
+        Queue op for key. Return a future set to the result of its write,
+        once op or an op replacing it is written.
+        '''
+        future = asyncio.get_running_loop().create_future()
+        entry = self.pending.get(key)
+        if entry is None:
+            self.pending[key] = [op, [future]]
+        else:
+            entry[0] = op
+            entry[1].append(future)
+            self.coalesced += 1
+        self.queued.set()
+        if len(self.pending) >= self.max_ops:
+            self.full.set()
+        return future
+
+    async def _run(self):
+        while True:
+            await self.queued.wait()
+            try:
+                await asyncio.wait_for(self.full.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            # a flush interrupted by close() would lose its ops, let it finish
+            await asyncio.shield(self.flush())
+
+    async def flush(self):
+        ''' Write the pending ops now, returning once they are written. '''
+        async with self.lock:
+            if len(self.pending) == 0:
+                return
+            batch = self.pending
+            self.pending = {}
+            self.queued.clear()
+            self.full.clear()
+            coalesced = self.coalesced
+            self.coalesced = 0
+            try:
+                results = await self.write({key: entry[0] for key, entry in batch.items()})
+            except Exception as e:
+                logger.error(f'Writing {len(batch)} buffered writes failed: {e}')
+                results = {key: e for key in batch}
+            logger.debug(f'Wrote {len(batch)} buffered writes, {coalesced} coalesced')
+            for key, (_, futures) in batch.items():
+                for future in futures:
+                    if not future.done():
+                        future.set_result(results.get(key))
+
+    async def close(self):
+        ''' Stop flushing in the background and write what is still pending. '''
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()